@@ -0,0 +1,196 @@
+import asyncio
+import struct
+import aiohttp
+import cv2
+import numpy as np
+from backends import FACE_MIN_SIZE
+from metrics import metrics
+
+# Discord's upload limit for unboosted servers; anything bigger isn't worth pulling into memory
+MAX_ATTACHMENT_BYTES = 8 * 1024 * 1024
+
+# Formats that can reach the models; anything else (PDFs, audio, video) isn't downloaded. GIFs are checked
+# on their first frame, which the media proxy serves as a PNG
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff', 'image/gif'}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff', '.gif')
+
+# Decoding takes width * height * 3 bytes, so bigger images are refused however small the file is
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+
+# The smallest face, as a fraction of an image's longest side, the age stage must still find. Its face
+# detector ignores faces under FACE_MIN_SIZE pixels, so images are only scaled down as far as keeps a face
+# this big over that: 2048px on the longest side, where a 4032px photo keeps faces down to 126px. Bigger
+# images are fetched and decoded at that size. Check changes against recall with `evaluate.py --max-side`.
+MIN_FACE_FRACTION = 1 / 32
+TARGET_SIZE = round(FACE_MIN_SIZE[0] / MIN_FACE_FRACTION)
+
+# cv2 decodes JPEGs at 1/2, 1/4 or 1/8 scale for a fraction of the work of a full decode
+_REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class AttachmentTooLarge(AttachmentError):
+    pass
+
+
+class AttachmentFetcher:
+    '''
+    Streams attachments into memory over one shared keep-alive session, refusing anything over `max_bytes`.
+    Nothing is written to disk.
+    '''
+
+    def __init__(self, max_bytes=MAX_ATTACHMENT_BYTES, timeout=30, chunk_size=64 * 1024):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def fetch(self, url):
+        session = self._get_session()
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    raise AttachmentError(f'Attachment download returned HTTP {response.status}')
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise AttachmentTooLarge(f'Attachment is {response.content_length} bytes')
+
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    buffer += chunk
+                    if len(buffer) > self.max_bytes:
+                        raise AttachmentTooLarge(f'Attachment is over {self.max_bytes} bytes')
+                return bytes(buffer)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise AttachmentError(f'Attachment download failed: {e!r}') from e
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def scaled_size(width, height, target=TARGET_SIZE):
+    '''
+    The (width, height) that fits an image within `target` on its longest side, or None if it already
+    fits or its size isn't known.
+    '''
+    if not target or not width or not height or max(width, height) <= target:
+        return None
+    scale = target / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _content_type(attachment):
+    return (attachment.content_type or '').split(';')[0].strip().lower()
+
+
+def is_gif(attachment):
+    content_type = _content_type(attachment)
+    return content_type == 'image/gif' if content_type else attachment.filename.lower().endswith('.gif')
+
+
+def screen(attachment, max_bytes=MAX_ATTACHMENT_BYTES, max_pixels=MAX_IMAGE_PIXELS):
+    '''
+    Decides from the metadata Discord sends with a message whether an attachment is worth downloading.
+    Returns why it should be skipped ('not_image', 'too_large' or 'too_many_pixels'), or None to check it.
+    Metadata that's missing never rejects an attachment on its own.
+    '''
+    content_type = _content_type(attachment)
+    if content_type:
+        if content_type not in IMAGE_TYPES:
+            return 'not_image'
+    elif not attachment.filename.lower().endswith(IMAGE_EXTENSIONS):
+        return 'not_image'
+    if attachment.width and attachment.height and attachment.width * attachment.height > max_pixels:
+        return 'too_many_pixels'
+    # A big original is fine as long as the media proxy can hand us a smaller copy instead
+    if attachment.size and attachment.size > max_bytes and download_url(attachment) == attachment.url:
+        return 'too_large'
+    return None
+
+
+def image_attachments(attachments):
+    '''
+    The attachments that pass `screen`. The skipped ones are counted, along with the bytes not downloaded.
+    '''
+    checked = []
+    for attachment in attachments:
+        reason = screen(attachment)
+        if reason is None:
+            checked.append(attachment)
+        else:
+            metrics.inc('attachments_skipped_total', reason=reason)
+            metrics.inc('attachment_bytes_saved_total', value=attachment.size or 0, reason=reason)
+    return checked
+
+
+def download_url(attachment, target=TARGET_SIZE):
+    '''
+    Where to fetch an attachment from: Discord's media proxy resizes images on request, so images bigger
+    than the models need are fetched already scaled down to `target`, and converts them, so a GIF is
+    fetched as a PNG of its first frame rather than every frame.
+    '''
+    size = scaled_size(attachment.width, attachment.height, target)
+    params = []
+    if is_gif(attachment):
+        params.append('format=png')
+    if size is not None:
+        params.append(f'width={size[0]}&height={size[1]}')
+    if not params or not attachment.proxy_url:
+        return attachment.url
+    separator = '&' if '?' in attachment.proxy_url else '?'
+    return f'{attachment.proxy_url}{separator}{"&".join(params)}'
+
+
+def image_size(data):
+    '''
+    Reads (width, height) from a PNG or JPEG header without decoding the image. Returns None for other
+    formats or a header it can't follow.
+    '''
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:2] != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        # Start-of-frame markers hold the dimensions; C4, C8 and CC share the range but are other segments
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[position + 5:position + 9])
+            return width, height
+        position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+    return None
+
+
+def decode_image(data, target=TARGET_SIZE):
+    '''
+    Decodes image bytes into a BGR array, the layout both cv2 and the models expect, no bigger than
+    `target` on its longest side (None decodes at full size). An animated image decodes to its first frame.
+    Returns None if the bytes aren't an image cv2 can read.
+    '''
+    flags = cv2.IMREAD_COLOR
+    size = image_size(data) if target else None
+    if size is not None:
+        for factor, reduced in _REDUCED:
+            if max(size) // factor >= target:
+                flags = reduced
+                break
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if image is None:
+        return None
+    fitted = scaled_size(image.shape[1], image.shape[0], target)
+    if fitted is not None:
+        image = cv2.resize(image, fitted, interpolation=cv2.INTER_AREA)
+    return image
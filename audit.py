@@ -0,0 +1,175 @@
+'''
+Append-only log of every moderation decision: which message, its scores, the thresholds it crossed, what
+the bot did and how long it took. Records are written by a background thread as a 4-byte big-endian length
+followed by compact JSON, into files named after the time they were started so they sort chronologically.
+
+    python audit.py --user 1234 --since 2026-10-01 --until 2026-10-08
+    python audit.py --guild 5678 --action delete
+'''
+import argparse
+import glob
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+
+LENGTH = struct.Struct('>I')
+AUDIT_DIR = 'audit'
+
+_STOP = object()
+
+
+class AuditLog:
+    '''
+    record() only puts the record on a queue; the writer thread encodes and appends it. A new file is
+    started once the current one reaches `max_bytes`, and only the newest `max_files` are kept.
+    '''
+
+    def __init__(self, directory=AUDIT_DIR, max_bytes=64 * 1024 * 1024, max_files=20, flush_interval=1.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.stats = {'records': 0, 'rotations': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+        self._thread.start()
+
+    def record(self, **fields):
+        fields.setdefault('time', time.time())
+        self._queue.put(fields)
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+            self.stats['rotations'] += 1
+        name = datetime.now().strftime('audit-%Y%m%dT%H%M%S%f.bin')
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        for old in log_files(self.directory)[:-self.max_files]:
+            os.remove(old)
+
+    def _run(self):
+        self._open()
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._file.flush()
+                continue
+            if record is _STOP:
+                break
+            data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            self._file.write(LENGTH.pack(len(data)) + data)
+            self.stats['records'] += 1
+            if self._file.tell() >= self.max_bytes:
+                self._open()
+        self._file.close()
+
+    def close(self):
+        '''
+        Writes everything recorded so far and stops the writer.
+        '''
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+
+def log_files(directory):
+    return sorted(glob.glob(os.path.join(directory, 'audit-*.bin')))
+
+
+def _file_start(path):
+    return datetime.strptime(os.path.basename(path), 'audit-%Y%m%dT%H%M%S%f.bin').timestamp()
+
+
+def read_records(path, needle=None):
+    '''
+    Yields every record in one file. With `needle`, records whose raw bytes don't contain it are skipped
+    without being decoded. A record cut short by a crash ends the file.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + LENGTH.size <= len(data):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > len(data):
+            break
+        raw = data[offset:offset + length]
+        offset += length
+        if needle is None or needle in raw:
+            yield json.loads(raw)
+
+
+def query(directory=AUDIT_DIR, user_id=None, guild_id=None, since=None, until=None, action=None):
+    '''
+    Yields matching records oldest first. Files that started after `until`, or were followed by a file that
+    started before `since`, are skipped without being opened.
+    '''
+    paths = log_files(directory)
+    starts = [_file_start(path) for path in paths]
+    # Compact JSON makes the user filter checkable on the raw bytes, before decoding
+    needle = f'"user_id":{user_id}'.encode() if user_id is not None else None
+    for i, path in enumerate(paths):
+        if until is not None and starts[i] > until:
+            break
+        if since is not None and i + 1 < len(paths) and starts[i + 1] < since:
+            continue
+        for record in read_records(path, needle):
+            if user_id is not None and record.get('user_id') != user_id:
+                continue
+            if guild_id is not None and record.get('guild_id') != guild_id:
+                continue
+            if since is not None and record['time'] < since:
+                continue
+            if until is not None and record['time'] > until:
+                continue
+            if action is not None and action not in record.get('actions', []):
+                continue
+            yield record
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Passes one in every `rate` records below `level` and every record at or above it.
+    '''
+
+    def __init__(self, rate=100, level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self._count = 0
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        self._count += 1
+        return self._count % self.rate == 0
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=AUDIT_DIR)
+    parser.add_argument('--user', type=int)
+    parser.add_argument('--guild', type=int)
+    parser.add_argument('--since', type=_timestamp, help='ISO date or time, local time')
+    parser.add_argument('--until', type=_timestamp, help='ISO date or time, local time')
+    parser.add_argument('--action', help='only decisions that included this action, e.g. delete or alert')
+    args = parser.parse_args()
+
+    for record in query(args.dir, args.user, args.guild, args.since, args.until, args.action):
+        print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    main()
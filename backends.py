@@ -0,0 +1,229 @@
+'''
+Inference backends for the image models. Every backend answers the same two questions, so csam_classifier
+doesn't care which one is loaded: how likely each image is to contain nudity, and the estimated age of
+every face in an image.
+
+'default' calls nudenet and PyAgender as before: nudenet runs its classifier on ONNX Runtime with default
+session settings, and PyAgender runs its age network on TensorFlow. 'onnx' runs both networks on ONNX Runtime
+with tuned sessions, doing the same preprocessing as the libraries, and 'onnx-int8' runs int8-quantized copies
+of them. The ONNX backends use
+
+    ~/.NudeNet/classifier_model.onnx    the model nudenet 2.0.9 ships, downloaded the first time nudenet runs
+    models/age_model.onnx               PyAgender's age/gender network, written by `python backends.py export`
+                                        (needs keras2onnx next to PyAgender's Keras and TensorFlow 1.x)
+
+and the int8 variants are written next to the age model with
+
+    python backends.py quantize
+'''
+import argparse
+import importlib.util
+import os
+from functools import partial
+import numpy as np
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+NUDE_MODEL_PATH = os.path.join(os.path.expanduser('~'), '.NudeNet', 'classifier_model.onnx')
+AGE_MODEL = 'age_model.onnx'
+
+DEFAULT_BACKEND = 'default'
+
+# nudenet's preprocessing: RGB, resized to 256x256 with PIL's nearest neighbour, scaled to [0, 1]
+NUDE_INPUT_SIZE = 256
+
+# PyAgender's face detection and preprocessing: its Haar cascade with these settings, boxes grown by
+# FACE_MARGIN on every side, and each face letterboxed into a 64x64 crop
+FACE_SCALE_FACTOR = 1.1
+FACE_MIN_NEIGHBORS = 8
+FACE_MIN_SIZE = (64, 64)
+FACE_MARGIN = 0.4
+AGE_INPUT_SIZE = 64
+
+
+def nude_input(image):
+    '''
+    Shrinks an image to the nudity model's input size the same way both backends would, so a backend
+    given the result scores it exactly as it would the full image. Only this much has to reach a pool worker.
+    '''
+    import cv2
+    return cv2.resize(image, (NUDE_INPUT_SIZE, NUDE_INPUT_SIZE), interpolation=cv2.INTER_NEAREST_EXACT)
+
+
+def face_cascade_path():
+    # PyAgender ships the cascade it uses; find it without importing the package, which loads TensorFlow
+    spec = importlib.util.find_spec('pyagender')
+    return os.path.join(os.path.dirname(spec.origin), 'pretrained_models', 'haarcascade_frontalface_default.xml')
+
+
+def aspect_resize(image, size):
+    '''
+    PyAgender's letterboxing resize: fits the image in a `size` square keeping its aspect ratio and pads
+    the rest by repeating the edge pixels.
+    '''
+    import cv2
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_height, new_width = int(height * ratio), int(width * ratio)
+    resized = cv2.resize(image, (new_width, new_height))
+    delta_h, delta_w = size - new_height, size - new_width
+    return cv2.copyMakeBorder(resized, delta_h // 2, delta_h - delta_h // 2, delta_w // 2, delta_w - delta_w // 2,
+                              cv2.BORDER_REPLICATE)
+
+
+class Backend:
+    '''
+    `nude_scores(images)` returns the probability that each image is unsafe and `face_ages(image)` the
+    estimated age of each face found in one image. Images are BGR uint8 arrays as decode_image returns them.
+    '''
+    name = None
+
+    def nude_scores(self, images):
+        raise NotImplementedError
+
+    def face_ages(self, image):
+        raise NotImplementedError
+
+    def warm_up(self):
+        # Run a blank image through each model so the first real image doesn't pay for graph construction
+        blank = np.zeros((256, 256, 3), dtype=np.uint8)
+        self.nude_scores([blank])
+        self.face_ages(blank)
+
+
+class DefaultBackend(Backend):
+    name = 'default'
+
+    def __init__(self, threads=None):
+        # The libraries size their own thread pools, so `threads` is left alone here to keep the old behaviour
+        from nudenet import NudeClassifier
+        from pyagender import PyAgender
+        self.nude = NudeClassifier()
+        self.age = PyAgender()
+
+    def nude_scores(self, images):
+        # nudenet keys results for in-memory images by their position in the list
+        results = self.nude.classify(images, batch_size=len(images))
+        return [results[i]['unsafe'] for i in range(len(images))]
+
+    def face_ages(self, image):
+        return [face['age'] for face in self.age.detect_genders_ages(image)]
+
+
+class OnnxBackend(Backend):
+    '''
+    Both networks on ONNX Runtime's CPU provider with full graph optimization. `threads` caps the threads
+    each session uses, so several pool workers can share the machine without oversubscribing it.
+    '''
+
+    def __init__(self, threads=None, int8=False, models_dir=MODELS_DIR):
+        import cv2
+        import onnxruntime as ort
+
+        self.name = 'onnx-int8' if int8 else 'onnx'
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = 1
+        if threads:
+            cv2.setNumThreads(threads)
+
+        nude_path = NUDE_MODEL_PATH
+        age_path = os.path.join(models_dir, AGE_MODEL)
+        if int8:
+            nude_path = os.path.join(models_dir, quantized_name(NUDE_MODEL_PATH))
+            age_path = os.path.join(models_dir, quantized_name(AGE_MODEL))
+        self.nude = ort.InferenceSession(nude_path, options, providers=['CPUExecutionProvider'])
+        self.age = ort.InferenceSession(age_path, options, providers=['CPUExecutionProvider'])
+        self.faces = cv2.CascadeClassifier(face_cascade_path())
+        self._cv2 = cv2
+
+    def nude_scores(self, images):
+        cv2 = self._cv2
+        # INTER_NEAREST_EXACT picks the same pixels as the PIL nearest neighbour resize nudenet uses
+        batch = np.stack([cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (NUDE_INPUT_SIZE, NUDE_INPUT_SIZE),
+                                     interpolation=cv2.INTER_NEAREST_EXACT)
+                          for image in images]).astype(np.float32) / 255
+        probabilities = self.nude.run(None, {self.nude.get_inputs()[0].name: batch})[0]
+        # Columns are [unsafe, safe], as in nudenet
+        return [float(row[0]) for row in probabilities]
+
+    def detect_faces(self, image):
+        cv2 = self._cv2
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        height, width = gray.shape
+        boxes = []
+        for x, y, w, h in self.faces.detectMultiScale(gray, scaleFactor=FACE_SCALE_FACTOR, minNeighbors=FACE_MIN_NEIGHBORS,
+                                                      minSize=FACE_MIN_SIZE, flags=cv2.CASCADE_SCALE_IMAGE):
+            boxes.append((max(int(x - FACE_MARGIN * w), 0), max(int(y - FACE_MARGIN * h), 0),
+                          min(int(x + w + FACE_MARGIN * w), width - 1), min(int(y + h + FACE_MARGIN * h), height - 1)))
+        return boxes
+
+    def face_ages(self, image):
+        boxes = self.detect_faces(image)
+        if not boxes:
+            return []
+        batch = np.stack([aspect_resize(image[top:bottom, left:right], AGE_INPUT_SIZE)
+                          for left, top, right, bottom in boxes]).astype(np.float32)
+        outputs = self.age.run(None, {self.age.get_inputs()[0].name: batch})
+        # The age head is a distribution over ages 0-100; the estimate is its expected value
+        distribution = next(output for output in outputs if output.shape[-1] == 101)
+        return [float(age) for age in distribution @ np.arange(101)]
+
+
+BACKENDS = {
+    'default': DefaultBackend,
+    'onnx': OnnxBackend,
+    'onnx-int8': partial(OnnxBackend, int8=True),
+}
+
+
+def create_backend(name=DEFAULT_BACKEND, threads=None):
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown inference backend {name!r}, expected one of {", ".join(BACKENDS)}')
+    return BACKENDS[name](threads=threads)
+
+
+def quantized_name(path):
+    return os.path.basename(path)[:-len('.onnx')] + '.int8.onnx'
+
+
+def export(models_dir=MODELS_DIR):
+    '''
+    Converts PyAgender's Keras network to ONNX.
+    '''
+    import keras2onnx
+    import onnx
+    from pyagender import PyAgender
+    os.makedirs(models_dir, exist_ok=True)
+    target = os.path.join(models_dir, AGE_MODEL)
+    onnx.save_model(keras2onnx.convert_keras(PyAgender().resnet, 'pyagender'), target)
+    print(f'Wrote {target}')
+
+
+def quantize(models_dir=MODELS_DIR):
+    '''
+    Writes int8 copies of both models, with dynamic quantization of the weights.
+    '''
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    for source in (NUDE_MODEL_PATH, os.path.join(models_dir, AGE_MODEL)):
+        target = os.path.join(models_dir, quantized_name(source))
+        quantize_dynamic(source, target, weight_type=QuantType.QInt8)
+        print(f'{source} ({os.path.getsize(source) / 1e6:.1f}MB) -> {target} ({os.path.getsize(target) / 1e6:.1f}MB)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help in (('export', "convert PyAgender's network to ONNX"), ('quantize', 'write int8 variants of both ONNX models')):
+        subparser = subparsers.add_parser(command, help=help)
+        subparser.add_argument('--models-dir', default=MODELS_DIR)
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args.models_dir)
+    else:
+        quantize(args.models_dir)
+
+
+if __name__ == '__main__':
+    main()
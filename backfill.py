@@ -0,0 +1,304 @@
+'''
+Sweeps the history of the group-# channels through the same scoring path as live messages, for guilds
+whose messages were sent before the bot joined. Nothing is deleted and nobody is warned: every message over
+a threshold is written to a JSON lines report for the moderators to go through.
+
+    python backfill.py                  # every group-# channel the bot can see
+    python backfill.py 1234 5678        # only these channel ids
+
+Progress is checkpointed per channel, so running it again after a crash picks up after the last message
+that was fully processed. A message that can't be scored (Perspective down or out of quota) is retried for a
+while; if it still can't be, the backfill stops there, and running it again later carries on from it.
+'''
+import asyncio
+import json
+import os
+import sys
+import discord
+import numpy as np
+import bot as botmodule
+from metrics import metrics
+from perspective import ATTRIBUTES
+
+CHECKPOINT_DIR = 'backfill_checkpoints'
+REPORT_PATH = 'backfill_report.jsonl'
+
+# Messages fetched ahead of the scorers; history paging stops while this many are waiting
+PREFETCH = 200
+SCORERS = 16
+CHECKPOINT_EVERY = 100
+# Most scored messages the writer puts through the guild's policy in one evaluate_batch call
+EVALUATE_BATCH = 64
+# How often a message that couldn't be scored is tried again, and the first wait in seconds, doubled each time
+SCORE_RETRIES = 5
+RETRY_DELAY = 10
+
+_DONE = object()
+
+
+class BackfillError(Exception):
+    pass
+
+
+class Checkpoints:
+    '''
+    The id of the last processed message in each channel, one small JSON file per channel. Files are
+    replaced atomically so a crash mid-write leaves the previous checkpoint.
+    '''
+
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, channel_id):
+        return os.path.join(self.directory, f'{channel_id}.json')
+
+    def load(self, channel_id):
+        try:
+            with open(self._path(channel_id)) as f:
+                return json.load(f)['last_message_id']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, channel_id, message_id):
+        path = self._path(channel_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'channel_id': channel_id, 'last_message_id': message_id}, f)
+        os.replace(path + '.tmp', path)
+
+
+async def history(channel, after_id=None):
+    '''
+    Yields a channel's messages oldest first, starting after `after_id`.
+    '''
+    after = discord.Object(id=after_id) if after_id else None
+    async for message in channel.history(limit=None, after=after, oldest_first=True):
+        yield message
+
+
+class Backfill:
+    '''
+    A three-stage pipeline per channel: one task pages through the history into a bounded queue, several
+    scorers run eval_text on what it fetched, and one writer puts whatever has been scored since it last
+    looked through the guild's policy in a single evaluate_batch call. Scorers finish out of order, so findings
+    are written, and the checkpoint moves past a message, only once every message before it is done too.
+    If a message can't be scored the scorers stop, what was fetched is dropped, and BackfillError is raised
+    with the checkpoint still before that message.
+    '''
+
+    def __init__(self, client, checkpoints=None, report_path=REPORT_PATH, prefetch=PREFETCH, scorers=SCORERS,
+                 checkpoint_every=CHECKPOINT_EVERY, evaluate_batch=EVALUATE_BATCH, retries=SCORE_RETRIES,
+                 retry_delay=RETRY_DELAY):
+        self.client = client
+        self.checkpoints = checkpoints or Checkpoints()
+        self.report_path = report_path
+        self.prefetch = prefetch
+        self.scorers = scorers
+        self.checkpoint_every = checkpoint_every
+        self.evaluate_batch = evaluate_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.stats = {'messages': 0, 'findings': 0}
+
+    async def run(self, channels):
+        with open(self.report_path, 'a', encoding='utf-8') as report:
+            for channel in channels:
+                await self.backfill_channel(channel, report)
+
+    async def backfill_channel(self, channel, report):
+        after_id = self.checkpoints.load(channel.id)
+        queue = asyncio.Queue(maxsize=self.prefetch)
+        scored = asyncio.Queue()
+        stopped = asyncio.Event()
+        done = {} # Map from sequence number to (message id, findings), for messages finished ahead of an earlier one
+        state = {'next': 0, 'last_id': after_id, 'since_checkpoint': 0}
+
+        async def produce():
+            seq = 0
+            async for message in history(channel, after_id):
+                if stopped.is_set():
+                    break
+                if message.author.id == self.client.user.id:
+                    continue
+                await queue.put((seq, message))
+                seq += 1
+            for _ in range(self.scorers):
+                await queue.put(_DONE)
+
+        def finish(seq, message_id, findings):
+            # Write out and advance the checkpoint over every message that is now done without a gap before it
+            done[seq] = (message_id, findings)
+            while state['next'] in done:
+                state['last_id'], findings = done.pop(state['next'])
+                self.stats['messages'] += 1
+                metrics.inc('backfill_messages_total')
+                for finding in findings:
+                    report.write(json.dumps(finding) + '\n')
+                    self.stats['findings'] += 1
+                state['next'] += 1
+                state['since_checkpoint'] += 1
+            if state['since_checkpoint'] >= self.checkpoint_every:
+                report.flush()
+                self.checkpoints.save(channel.id, state['last_id'])
+                state['since_checkpoint'] = 0
+
+        async def score():
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                # Once stopped, what was already fetched is dropped so the producer gets to see it
+                if stopped.is_set():
+                    continue
+                seq, message = item
+                scores_all = await self.score_message(message)
+                if scores_all is None:
+                    print(f'Cannot backfill message {message.id} because it could not be scored, stopping')
+                    stopped.set()
+                    continue
+                scored.put_nowait((seq, message, scores_all))
+
+        async def write():
+            while True:
+                chunk = [await scored.get()]
+                while len(chunk) < self.evaluate_batch and not scored.empty():
+                    chunk.append(scored.get_nowait())
+                items = [item for item in chunk if item is not _DONE]
+                findings = {}
+                for finding in self.findings(channel.guild.id, [(message, scores_all) for _, message, scores_all in items]):
+                    findings.setdefault(finding['message_id'], []).append(finding)
+                for seq, message, _ in items:
+                    finish(seq, message.id, findings.get(message.id, []))
+                if len(items) < len(chunk):
+                    return
+
+        async def score_all():
+            try:
+                await asyncio.gather(*(score() for _ in range(self.scorers)))
+            finally:
+                scored.put_nowait(_DONE)
+
+        print(f'Backfilling #{channel.name} in {channel.guild.name}' + (f' after {after_id}' if after_id else ''))
+        producer = asyncio.create_task(produce())
+        try:
+            await asyncio.gather(producer, score_all(), write())
+            if stopped.is_set():
+                raise BackfillError(f'Stopped backfilling #{channel.name} at a message that could not be scored')
+        finally:
+            producer.cancel()
+            report.flush()
+            if state['last_id'] is not None:
+                self.checkpoints.save(channel.id, state['last_id'])
+
+    async def score_message(self, message):
+        '''
+        eval_text, tried again with backoff while the message can't be scored. Returns None if it never could be.
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                scores_all = await self.client.eval_text(message)
+            except Exception as e:
+                print(f'Cannot score message {message.id} because ', e)
+                continue
+            # eval_text leaves the text scores as None when Perspective couldn't be reached
+            if scores_all[1] is not None or not message.content:
+                return scores_all
+        return None
+
+    def findings(self, guild_id, scored):
+        '''
+        Takes (message, eval_text result) pairs and returns a finding for each flagged image and each text
+        score that crosses a threshold. Images are flagged by the CSAM check itself, as in handle_report; the
+        text scores are evaluated against the guild's policy all at once.
+        '''
+        findings = []
+
+        def add(message, source, level, attributes, scores):
+            findings.append({
+                'guild_id': message.guild.id,
+                'channel_id': message.channel.id,
+                'message_id': message.id,
+                'author_id': message.author.id,
+                'author': str(message.author),
+                'created_at': message.created_at.isoformat(),
+                'content': message.content,
+                'source': source,
+                'level': level,
+                'attributes': attributes,
+                'scores': scores,
+            })
+
+        for message, (image_scores, _) in scored:
+            if image_scores == botmodule.CSAM_IMAGE_SCORES:
+                add(message, 'image', 'toxic', ['CSAM'], image_scores)
+
+        rows = [(message, scores) for message, (_, scores) in scored if scores is not None]
+        if not rows:
+            return findings
+        levels, toxic, questionable = self.client.policy.evaluate_batch(guild_id, [scores for _, scores in rows])
+        for i, (message, scores) in enumerate(rows):
+            if not levels[i]:
+                continue
+            crossed = toxic[i] if levels[i] == 1 else questionable[i]
+            add(message, 'text', 'toxic' if levels[i] == 1 else 'questionable',
+                [ATTRIBUTES[j] for j in np.flatnonzero(crossed)], scores)
+        return findings
+
+
+class BackfillBot(botmodule.ModBot):
+    '''
+    ModBot that backfills the group-# channels once it has connected and then exits. It leaves live
+    traffic alone, since the normal bot is the one moderating that.
+    '''
+
+    def __init__(self, key, channel_ids=None):
+        super().__init__(key)
+        self.channel_ids = set(channel_ids or [])
+        self.backfill_task = None
+
+    async def on_ready(self):
+        await super().on_ready()
+        # on_ready fires again after a reconnect; the backfill only ever runs once
+        if self.backfill_task is None:
+            self.backfill_task = asyncio.create_task(self.backfill())
+
+    async def backfill(self):
+        # History has images in it, so wait for the models rather than queueing the whole backfill
+        await self.warm_up_task
+        if self.channel_ids:
+            channels = [channel for channel in map(self.get_channel, self.channel_ids) if channel is not None]
+        else:
+            channels = list(self.channel_index.monitored.values())
+        backfill = Backfill(self)
+        try:
+            await backfill.run(channels)
+            print(f'Backfilled {backfill.stats["messages"]} messages, {backfill.stats["findings"]} findings written to {backfill.report_path}')
+        except BackfillError as e:
+            print(f'{e}; run it again later to carry on from there. {backfill.stats["messages"]} messages backfilled, '
+                  f'{backfill.stats["findings"]} findings written to {backfill.report_path}')
+        finally:
+            await self.close()
+
+    async def close(self):
+        # Stopped from outside (Ctrl-C): the backfill saves its checkpoints as it is cancelled
+        if self.backfill_task is not None and self.backfill_task is not asyncio.current_task():
+            self.backfill_task.cancel()
+        await super().close()
+
+    async def on_message(self, message):
+        pass
+
+    async def on_message_edit(self, before, message):
+        pass
+
+    async def on_raw_reaction_add(self, payload):
+        pass
+
+
+if __name__ == '__main__':
+    discord_token, perspective_key = botmodule.load_tokens()
+    client = BackfillBot(perspective_key, [int(arg) for arg in sys.argv[1:]])
+    # Without a handler of discord.py's own, warnings and errors still reach stderr through logging's last resort
+    client.run(discord_token, log_handler=None)
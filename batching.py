@@ -0,0 +1,53 @@
+import asyncio
+
+
+class MicroBatcher:
+    '''
+    Collects items submitted by concurrent callers and runs them through `run_batch` together. A batch is
+    sent once it holds `max_batch_size` items or the oldest item has waited `max_wait` seconds, whichever
+    comes first; each caller gets back the result at its own position.
+    '''
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.02):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = {'batches': 0, 'items': 0}
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        # Callers that gave up while waiting (e.g. the cascade cancelled them) don't need inference
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        self.stats['batches'] += 1
+        self.stats['items'] += len(batch)
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,133 @@
+'''
+Compares the image inference backends on a local directory of images: model load time, per-image latency,
+batched throughput, peak memory, and how closely each backend's scores and CSAM verdicts agree with the
+first backend listed (the current models by default).
+
+    python benchmarks/backends.py path/to/images --backends default onnx onnx-int8 --threads 4
+
+Each backend runs in its own fresh process, so load time and peak memory aren't shared between them.
+'''
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from attachments import decode_image
+from backends import BACKENDS
+from csam_classifier import NUDE_THRESHOLD, AGE_THRESHOLD
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png')
+
+
+def find_images(image_dir):
+    paths = []
+    for root, _, filenames in os.walk(image_dir):
+        paths.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                     if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def profile(name, threads, paths, batch):
+    '''
+    Runs in a fresh worker process: loads the backend, then scores every image one at a time and in batches.
+    '''
+    from backends import create_backend
+    images = [decode_image(open(path, 'rb').read()) for path in paths]
+    images = [image for image in images if image is not None]
+
+    start = time.perf_counter()
+    backend = create_backend(name, threads)
+    backend.warm_up()
+    load = time.perf_counter() - start
+
+    latencies = []
+    nude, ages = [], []
+    for image in images:
+        start = time.perf_counter()
+        nude.append(backend.nude_scores([image])[0])
+        ages.append(min(backend.face_ages(image), default=200))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(images), batch):
+        backend.nude_scores(images[i:i + batch])
+    batched = time.perf_counter() - start
+
+    return {
+        'load': load,
+        'latencies': latencies,
+        'throughput': len(images) / batched if batched else 0,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'nude': nude,
+        'ages': ages,
+    }
+
+
+def agreement(reference, result):
+    pairs = list(zip(reference['nude'], reference['ages'], result['nude'], result['ages']))
+    # Faces found by one backend and missed by the other have no age to compare
+    age_pairs = [(a, b) for _, a, _, b in pairs if a < 200 and b < 200]
+    return {
+        'nude_delta': statistics.mean(abs(a - b) for a, _, b, _ in pairs),
+        'nude_decision': statistics.mean((a > NUDE_THRESHOLD) == (b > NUDE_THRESHOLD) for a, _, b, _ in pairs),
+        'age_delta': statistics.mean(abs(a - b) for a, b in age_pairs) if age_pairs else float('nan'),
+        'age_decision': statistics.mean((a < AGE_THRESHOLD) == (b < AGE_THRESHOLD) for _, a, _, b in pairs),
+        'verdict': statistics.mean((n1 > NUDE_THRESHOLD and a1 < AGE_THRESHOLD) == (n2 > NUDE_THRESHOLD and a2 < AGE_THRESHOLD)
+                                   for n1, a1, n2, a2 in pairs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS),
+                        help='backends to compare; agreement is measured against the first')
+    parser.add_argument('--threads', type=int, default=None, help='threads per backend (default: all cores)')
+    parser.add_argument('--batch', type=int, default=8, help='batch size for the throughput run')
+    args = parser.parse_args()
+
+    paths = find_images(args.image_dir)
+    if not paths:
+        sys.exit(f'No images found in {args.image_dir}')
+    print(f'{len(paths)} images, threads {args.threads or "default"}, batch {args.batch}')
+
+    results = {}
+    for name in args.backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                result = executor.submit(profile, name, args.threads, paths, args.batch).result()
+            except Exception as e:
+                print(f'{name:>10}: failed ({e!r})')
+                continue
+        results[name] = result
+        latencies = [latency * 1000 for latency in result['latencies']]
+        print(f'{name:>10}: load {result["load"]:5.1f}s  p50 {percentile(latencies, 50):7.1f}ms  '
+              f'p95 {percentile(latencies, 95):7.1f}ms  {result["throughput"]:6.1f} images/s batched  '
+              f'peak RSS {result["max_rss_mb"]:6.0f}MB')
+
+    if len(results) < 2:
+        return
+    reference_name = next(iter(results))
+    reference = results[reference_name]
+    print(f'Agreement with {reference_name}:')
+    for name, result in results.items():
+        if name == reference_name:
+            continue
+        agree = agreement(reference, result)
+        print(f'{name:>10}: nudity |delta| {agree["nude_delta"]:.3f}, same decision {agree["nude_decision"]:.1%}  '
+              f'age |delta| {agree["age_delta"]:.1f}y, same decision {agree["age_decision"]:.1%}  '
+              f'same CSAM verdict {agree["verdict"]:.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Measures nudity-model throughput and latency through the micro-batcher at several batch settings.
+
+    python benchmarks/batching.py path/to/images --requests 200 --concurrency 32
+
+Every image in the directory is decoded and shrunk to the model's input once, and then submitted round-robin
+by `concurrency` simultaneous callers, the same way concurrent eval_im calls reach the batcher in the bot.
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import csam_classifier as csam
+from attachments import decode_image
+from backends import nude_input
+from batching import MicroBatcher
+
+# (max batch size, max wait in seconds); batch size 1 is the unbatched baseline
+SETTINGS = [(1, 0.0), (4, 0.01), (8, 0.02), (16, 0.02), (16, 0.05), (32, 0.05)]
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def load_images(image_dir):
+    images = []
+    for filename in sorted(os.listdir(image_dir)):
+        if filename.lower().endswith(('jpg', 'jpeg', 'png')):
+            with open(os.path.join(image_dir, filename), 'rb') as f:
+                image = decode_image(f.read())
+            if image is not None:
+                images.append(nude_input(image))
+    return images
+
+
+async def run_setting(images, max_batch_size, max_wait, requests, concurrency):
+    batcher = MicroBatcher(csam._run_nude_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(images[i % len(images)])
+
+    async def caller():
+        while not queue.empty():
+            image = queue.get_nowait()
+            start = time.perf_counter()
+            await batcher.submit(image)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    mean_batch = batcher.stats['items'] / max(batcher.stats['batches'], 1)
+    print(f'batch {max_batch_size:>3} wait {max_wait * 1000:>4.0f}ms: {requests / elapsed:7.1f} images/s  '
+          f'p50 {percentile(latencies, 50) * 1000:7.1f}ms  p95 {percentile(latencies, 95) * 1000:7.1f}ms  '
+          f'mean batch {mean_batch:.1f}')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir')
+    parser.add_argument('--requests', type=int, default=200, help='images to classify per setting')
+    parser.add_argument('--concurrency', type=int, default=32, help='simultaneous callers')
+    parser.add_argument('--workers', type=int, default=2, help='model pool worker processes')
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir)
+    if not images:
+        raise SystemExit(f'No images found in {args.image_dir}')
+
+    csam.pool.workers = args.workers
+    csam.pool.start()
+    # One warm-up batch per worker so model loading isn't counted against the first setting
+    await asyncio.gather(*(csam._run_nude_batch(images[:1]) for _ in range(args.workers)))
+    for max_batch_size, max_wait in SETTINGS:
+        await run_setting(images, max_batch_size, max_wait, args.requests, args.concurrency)
+    csam.pool.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
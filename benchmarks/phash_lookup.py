@@ -0,0 +1,62 @@
+'''
+Measures HashIndex lookup latency with a large number of known images.
+
+    python benchmarks/phash_lookup.py --size 1000000
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from phash import HashIndex, FLAGGED, CLEARED
+
+
+def flip_bits(value, count):
+    for bit in random.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1000000, help='number of hashes in the index')
+    parser.add_argument('--queries', type=int, default=10000, help='number of lookups to time per query type')
+    parser.add_argument('--seed', type=int, default=152)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    index = HashIndex()
+    known = []
+    start = time.perf_counter()
+    for _ in range(args.size):
+        hashes = (random.getrandbits(64), random.getrandbits(64))
+        index.add(hashes, random.choice((FLAGGED, CLEARED)))
+        known.append(hashes)
+    print(f'Built index of {len(index)} hashes in {time.perf_counter() - start:.1f}s')
+
+    queries = {
+        'exact repost': [random.choice(known) for _ in range(args.queries)],
+        'near duplicate (4 bits)': [tuple(flip_bits(h, 4) for h in random.choice(known)) for _ in range(args.queries)],
+        'unknown image': [(random.getrandbits(64), random.getrandbits(64)) for _ in range(args.queries)],
+    }
+    for name, hashes_list in queries.items():
+        timings = []
+        found = 0
+        for hashes in hashes_list:
+            start = time.perf_counter()
+            label = index.lookup(hashes)
+            timings.append((time.perf_counter() - start) * 1e6)
+            found += label is not None
+        print(f'{name:>24}: p50 {percentile(timings, 50):7.1f}us  p99 {percentile(timings, 99):7.1f}us  '
+              f'matched {found}/{len(hashes_list)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''
+Measures how many Perspective calls the pre-screen avoids and how often it agrees with Perspective.
+
+    python benchmarks/prescreen.py corpus.jsonl [--holdout 0.2]
+
+The corpus has the format described in prescreen.py. With --holdout, a model is trained on the rest of
+the corpus and evaluated on the held-out fraction; otherwise the trained prescreen_model.json is used.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prescreen import PreScreen, LinearModel, features, normalize, read_corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus')
+    parser.add_argument('--holdout', type=float, default=0.0, help='fraction held out when training a model here')
+    parser.add_argument('--seed', type=int, default=152)
+    args = parser.parse_args()
+
+    corpus = list(read_corpus(args.corpus))
+    screen = PreScreen()
+    if args.holdout:
+        random.Random(args.seed).shuffle(corpus)
+        split = int(len(corpus) * (1 - args.holdout))
+        screen.model = LinearModel()
+        screen.model.train([(features(normalize(text)), label) for text, label in corpus[:split]])
+        corpus = corpus[split:]
+    if screen.model is None:
+        raise SystemExit('No trained model: run `python prescreen.py train` first or pass --holdout')
+
+    avoided = agree = missed = positives = 0
+    start = time.perf_counter()
+    for text, label in corpus:
+        benign = screen.is_benign(text)
+        positives += label
+        if benign:
+            avoided += 1
+            agree += not label
+            missed += label
+    elapsed = time.perf_counter() - start
+
+    total = len(corpus)
+    print(f'{total} messages, {positives} that Perspective would flag')
+    print(f'Perspective calls avoided: {avoided} ({avoided / total:.1%})')
+    print(f'agreement with Perspective on avoided calls: {agree / max(avoided, 1):.2%}')
+    print(f'flaggable messages let through: {missed} ({missed / max(positives, 1):.2%} of flaggable)')
+    print(f'{elapsed / total * 1e6:.1f}us per message')
+
+
+if __name__ == '__main__':
+    main()
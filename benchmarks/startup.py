@@ -0,0 +1,94 @@
+'''
+Measures how long the bot takes to start moderating text, and how long the image models take to load
+behind it. Each measurement runs in a fresh interpreter so nothing is already imported.
+
+    python benchmarks/startup.py --repeat 5
+    python benchmarks/startup.py --models    # also time the image model warm-up (needs nudenet and pyagender)
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each snippet prints the seconds from interpreter start to the point being measured
+PRELUDE = f'''
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {ROOT!r})
+'''
+
+SNIPPETS = {
+    # What gates text moderation now: the bot module and a ModBot with its workers running
+    'text ready': '''
+import asyncio
+import bot
+async def main():
+    client = bot.ModBot('benchmark')
+    client.scheduler.start()
+    print(time.perf_counter() - start)
+    client.scheduler.stop()
+asyncio.run(main())
+''',
+    # What used to gate it as well: the image pipeline imported along with the bot
+    'text ready, image pipeline imported eagerly': '''
+import asyncio
+import bot
+import csam_classifier
+async def main():
+    client = bot.ModBot('benchmark')
+    client.scheduler.start()
+    print(time.perf_counter() - start)
+    client.scheduler.stop()
+asyncio.run(main())
+''',
+}
+
+MODEL_SNIPPET = '''
+import asyncio
+import csam_classifier
+async def main():
+    await csam_classifier.pool.wait_ready()
+    print(time.perf_counter() - start)
+    csam_classifier.pool.shutdown()
+if __name__ == '__main__':
+    asyncio.run(main())
+'''
+
+
+def measure(snippet, cwd):
+    script = os.path.join(cwd, 'startup_snippet.py')
+    with open(script, 'w') as f:
+        f.write(PRELUDE + snippet)
+    result = subprocess.run([sys.executable, script], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--models', action='store_true', help='also time loading the image models')
+    args = parser.parse_args()
+
+    snippets = dict(SNIPPETS)
+    if args.models:
+        snippets['image models loaded'] = MODEL_SNIPPET
+
+    # The bot creates its databases in the working directory, so keep them out of the repo
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, snippet in snippets.items():
+            try:
+                samples = [measure(snippet, cwd) for _ in range(args.repeat)]
+            except RuntimeError as e:
+                print(f'{name}: failed ({e})')
+                continue
+            print(f'{name}: median {statistics.median(samples):.2f}s  min {min(samples):.2f}s  max {max(samples):.2f}s')
+
+
+if __name__ == '__main__':
+    main()
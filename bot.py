@@ -2,48 +2,124 @@
 import discord
 from discord.ext import commands
 import os
+import argparse
 import json
 import logging
+import logging.handlers
+import queue
+import time
+import asyncio
 import re
-import requests 
-from report import Report, State
+import importlib
+from collections import deque, OrderedDict
+from report import Report, State, Type, ToxicThreshold
+from context import ModerationContext
+from perspective import PerspectiveClient, PerspectiveError, ATTRIBUTES
+from score_cache import ScoreCache, normalize_text
+from state_store import StateStore
+from prescreen import PreScreen
+from policy import PolicyEngine
+from dispatcher import Dispatcher
+from channel_index import ChannelIndex
+from recent import RecentMessages
+from audit import AuditLog, SampleFilter
+from scheduler import Scheduler, DM, IMAGE, TEXT, CLASS_NAMES
+from flood import FloodDetector
+from attachments import screen, image_attachments
+from metrics import metrics
+from loadtest.recorder import TrafficRecorder
 import emoji
-import csam_classifier as csam
-
-# Set up logging to the console
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'token.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
-
-
-class ModBot(discord.Client):
-    def __init__(self, key):
+
+# Messages are moderated by this many workers at once, DM reports first, then attachments, then text.
+# Per class, in that order: how many can be waiting, and how many seconds they can wait before being
+# dropped (None: never dropped)
+MESSAGE_WORKERS = 16
+QUEUE_SIZES = (100, 500, 1000)
+QUEUE_DEADLINES = (None, 300, 60)
+
+# The images of messages that arrive while the image models are still loading wait here, at most this many;
+# their text is moderated right away
+PENDING_IMAGES = 1000
+
+# Perspective scores are cached here across restarts; set to None to keep the cache in memory only
+SCORE_CACHE_PATH = 'score_cache.db'
+
+# Warning counts and in-progress reports are kept here across restarts
+STATE_STORE_PATH = 'state.db'
+
+# Per-guild moderation thresholds; edits are picked up while the bot runs. Without the file report.py's thresholds apply
+POLICY_PATH = 'policy.json'
+
+# What eval_text reports for a message's images. The CSAM verdict is the image cascade's own: guild policy only
+# tunes the text thresholds, so no policy can turn CSAM removal off
+CSAM_IMAGE_SCORES = {'SEVERE_TOXICITY': 1, 'PROFANITY': 1, 'IDENTITY_ATTACK': 1, 'THREAT': 1, 'TOXICITY': 1, 'FLIRTATION': 0.5}
+CLEAN_IMAGE_SCORES = {'SEVERE_TOXICITY': 0, 'PROFANITY': 0, 'IDENTITY_ATTACK': 0, 'THREAT': 0, 'TOXICITY': 0, 'FLIRTATION': 0}
+# The thresholds a CSAM image is reported as crossing when its author is warned
+CSAM_THRESHOLDS = [ToxicThreshold[attr] for attr, score in CSAM_IMAGE_SCORES.items() if score > ToxicThreshold[attr].value]
+
+# Alerts and notices raised within this many seconds of each other are sent as one message
+DISPATCH_WINDOW = 1.0
+
+# Moderator reactions label the images of at most this many recent image alerts
+IMAGE_ALERT_HISTORY = 10000
+
+# Shards this process runs. None lets Discord pick the shard count and runs every shard here; to split a large
+# deployment across processes give each one the same SHARD_COUNT and its own SHARD_IDS (--shard-count/--shard-ids).
+# DMs only reach the process running shard 0, and it can only accept reports about messages in its own guilds,
+# so DM reporting needs every guild in one process
+SHARD_COUNT = None
+SHARD_IDS = None
+
+# Every moderation decision is appended to the audit log here (query it with audit.py); None turns it off
+AUDIT_DIR = 'audit'
+
+# Only one in this many of the discord library's DEBUG records is written to discord.log
+DEBUG_LOG_SAMPLE = 100
+
+# Set to a port to serve Prometheus metrics on http://127.0.0.1:<port>/metrics; off by default
+METRICS_PORT = None
+
+# Set to a path to record channel traffic for replaying with `python -m loadtest.run --replay`
+TRAFFIC_RECORD_PATH = None
+
+
+class ModBot(discord.AutoShardedClient):
+    def __init__(self, key, shard_count=None, shard_ids=None):
         intents = discord.Intents.default()
-        super().__init__(command_prefix='.', intents=intents)
+        # Privileged: without it guild messages arrive with empty text. It also has to be enabled for the bot
+        # in the Discord developer portal
+        intents.message_content = True
+        super().__init__(command_prefix='.', intents=intents, shard_count=shard_count, shard_ids=shard_ids)
         self.group_num = None   
-        self.mod_channels = {} # Map from guild to the mod channel id for that guild
+        self.channel_index = None # Group and mod channels by id, built once the bot knows its group number
         self.reports = {} # Map from user IDs to the state of their report
         self.perspective_key = key
-        self.warning_count = {} # no of times a user's message is flagged
-        self._user_ban_message = None
-        self._permission_denied = None
-        self._toxic_state = False
-        self.state = None
-        self.original_message = self.message = None
-        self.continue_report = None
-        self.private_dm_guild = None
+        self.perspective = PerspectiveClient(key)
+        self.score_cache = ScoreCache(db_path=SCORE_CACHE_PATH)
+        self.prescreen = PreScreen()
+        self.flood = FloodDetector() # Near-duplicate texts and posting rates, for spam waves
+        self.policy = PolicyEngine(POLICY_PATH)
+        self.store = StateStore(STATE_STORE_PATH) # no of times a user's message is flagged, and reports in progress
+        self.scheduler = Scheduler(MESSAGE_WORKERS, QUEUE_SIZES, QUEUE_DEADLINES)
+        self.csam = None # csam_classifier once its models are loaded by warm_up; until then, or if they fail to load, only text is moderated
+        self.images_ready = asyncio.Event()
+        self.pending_images = deque(maxlen=PENDING_IMAGES)
+        self.warm_up_task = None
+        self.recorder = TrafficRecorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
+        self.dispatcher = Dispatcher(window=DISPATCH_WINDOW)
+        self.audit = AuditLog(AUDIT_DIR) if AUDIT_DIR else None
+        self.recent = RecentMessages() # Recent messages in the group channels and what moderation made of them
+        self.image_alerts = OrderedDict() # Map from image alert message IDs to the ID of the flagged message, oldest first
+
+    async def setup_hook(self):
+        # Parse the group number out of the bot's name. This runs after login and before any guild arrives,
+        # so every guild can be indexed as it becomes available
+        match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
+        if match:
+            self.group_num = match.group(1)
+        else:
+            raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
+        self.channel_index = ChannelIndex(self.group_num)
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -51,18 +127,101 @@ class ModBot(discord.Client):
             print(f' - {guild.name}')
         print('Press Ctrl-C to quit.')
 
-        # Parse the group number out of the bot's name
-        match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
-        if match:
-            self.group_num = match.group(1)
-        else:
-            raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
-        
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+        # Text moderation starts right away; the image models load in the background
+        self.scheduler.start()
+        self.score_cache.start()
+        if self.warm_up_task is None:
+            self.warm_up_task = asyncio.create_task(self.warm_up())
+
+        if METRICS_PORT:
+            self.register_metrics()
+            await metrics.serve(port=METRICS_PORT)
+
+    async def warm_up(self):
+        '''
+        Imports the image pipeline and waits for every pool worker to load its models, then releases the
+        images that arrived in the meantime. If the models can't be loaded the bot carries on moderating
+        text only.
+        '''
+        start = time.perf_counter()
+        csam = None
+        try:
+            csam = await asyncio.to_thread(importlib.import_module, 'csam_classifier')
+            await csam.pool.wait_ready()
+            self.csam = csam
+            print(f'Image models loaded in {time.perf_counter() - start:.1f}s')
+        except Exception as e:
+            print('Cannot load the image models, moderating text only, because ', repr(e))
+            if csam is not None:
+                csam.pool.shutdown()
+        metrics.observe('warm_up_seconds', time.perf_counter() - start)
+        self.images_ready.set()
+        while self.pending_images:
+            message, before = self.pending_images.popleft()
+            await self.scheduler.submit(IMAGE, self.handle_channel_message, message, before, False, True)
+
+    async def submit_image(self, message, before, sighting=None):
+        if self.images_ready.is_set():
+            await self.scheduler.submit(IMAGE, self.handle_channel_message, message, before, True, True, sighting)
+            return
+        # Until the models are loaded the text is moderated right away, and only the images wait, outside the
+        # scheduler so they don't hold up a worker
+        if before is None or self.edit_changes(before, message)[0]:
+            await self.scheduler.submit(TEXT, self.handle_channel_message, message, before, True, False, sighting)
+        if len(self.pending_images) == self.pending_images.maxlen:
+            metrics.inc('scheduler_shed_total', **{'class': 'image', 'reason': 'warm_up'})
+        self.pending_images.append((message, before))
+
+    # Keep the channel index current instead of searching guilds for the group channels
+    async def on_guild_available(self, guild):
+        self.channel_index.add_guild(guild)
+
+    async def on_guild_join(self, guild):
+        self.channel_index.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.channel_index.remove_guild(guild)
+
+    async def on_guild_channel_create(self, channel):
+        self.channel_index.update_channel(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            self.channel_index.update_channel(after)
+
+    async def on_guild_channel_delete(self, channel):
+        self.channel_index.remove_channel(channel)
+
+    def register_metrics(self):
+        metrics.gauge('scheduler_queue_depth', lambda: {(('class', name),): self.scheduler.depth(priority) for priority, name in enumerate(CLASS_NAMES)},
+                      'messages waiting for a worker, by priority class')
+        metrics.gauge('scheduler_degraded', lambda: int(self.scheduler.degraded), '1 while text is scored from the cache only')
+        metrics.gauge('dispatcher_pending', self.dispatcher.pending, 'messages waiting to be sent to Discord')
+        metrics.gauge('flood_index_entries', lambda: len(self.flood), 'distinct recent texts in the near-duplicate index')
+        metrics.gauge('recent_hit_rate', self.recent.hit_rate, 'fraction of reported messages found in memory')
+        metrics.gauge('score_cache', lambda: {(('event', event),): value for event, value in self.score_cache.stats.items()},
+                      'Perspective score cache hits, misses and evictions since startup')
+        metrics.gauge('image_models_ready', lambda: int(self.csam is not None), '1 once the image models are loaded')
+        metrics.gauge('image_stage_skip_rate', lambda: {(('stage', stage),): rate for stage, rate in self.csam.cascade.skip_rates().items()} if self.csam else {},
+                      'fraction of images for which each cascade stage was skipped')
+
+    async def close(self):
+        await metrics.close()
+        if self.recorder:
+            self.recorder.close()
+        if self.audit:
+            self.audit.close()
+        self.scheduler.stop()
+        await self.dispatcher.close()
+        await self.perspective.close()
+        await self.store.close()
+        await self.score_cache.close()
+        if self.warm_up_task:
+            self.warm_up_task.cancel()
+        if self.csam:
+            await self.csam.fetcher.close()
+            self.csam.pool.shutdown()
+        await super().close()
 
     async def on_message(self, message):
         '''
@@ -72,12 +231,40 @@ class ModBot(discord.Client):
         # Ignore messages from us 
         if message.author.id == self.user.id:
             return
+
+        if self.recorder:
+            self.recorder.record(message)
         
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
-            await self.handle_channel_message(message)
+            # Only messages in the "group-#" channels are moderated, so don't queue the rest
+            if self.channel_index.is_monitored(message.channel.id):
+                self.recent.add(message)
+                # Counted on arrival, by when it was posted, so messages the scheduler drops during a raid
+                # still count towards it
+                sighting = self.flood.observe(message)
+                if any(screen(attachment) is None for attachment in message.attachments):
+                    await self.submit_image(message, None, sighting)
+                else:
+                    await self.scheduler.submit(TEXT, self.handle_channel_message, message, None, True, True, sighting)
         else:
-            await self.handle_dm(message)
+            await self.scheduler.submit(DM, self.handle_dm, message)
+
+    async def on_raw_reaction_add(self, payload):
+        '''
+        This function is called whenever a reaction is added to a message. Moderator reactions on our alerts
+        are fed back to the image hash index so reposts of the same image are resolved without the models.
+        Only alerts raised by the image cascade count; a text or flood alert says nothing about the images.
+        Image alerts are sent on their own, so a reaction always speaks for exactly one message.
+        '''
+        if payload.user_id == self.user.id or payload.message_id not in self.image_alerts or self.csam is None:
+            return
+
+        emoji = str(payload.emoji)
+        if emoji in ('\N{CROSS MARK}', '\N{NO PEDESTRIANS}'):
+            self.csam.record_decision(self.image_alerts.pop(payload.message_id), True)
+        elif emoji == '\N{WHITE HEAVY CHECK MARK}':
+            self.csam.record_decision(self.image_alerts.pop(payload.message_id), False)
 
     async def on_message_edit(self, before, message):
         '''
@@ -90,111 +277,137 @@ class ModBot(discord.Client):
         
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
-            await self.handle_channel_message(message)
+            if not self.channel_index.is_monitored(message.channel.id):
+                return
+            # Embed unfurls and pins also fire edits; only moderate edits that changed something we score
+            text_changed, new_attachments = self.edit_changes(before, message)
+            if not text_changed and not new_attachments:
+                metrics.inc('edits_skipped_total')
+                return
+            self.recent.add(message)
+            if any(screen(attachment) is None for attachment in new_attachments):
+                await self.submit_image(message, before)
+            else:
+                await self.scheduler.submit(TEXT, self.handle_channel_message, message, before)
         else:
-            await self.handle_dm(message)
+            await self.scheduler.submit(DM, self.handle_dm, message)
 
+    def edit_changes(self, before, message):
+        '''
+        Returns whether an edit changed the message text (ignoring whitespace) and which attachments it added.
+        '''
+        text_changed = normalize_text(before.content) != normalize_text(message.content)
+        seen = {attachment.id for attachment in before.attachments}
+        new_attachments = [attachment for attachment in message.attachments if attachment.id not in seen]
+        return text_changed, new_attachments
 
-    async def handle_report(self, message, type_dm=False):
+
+    async def handle_report(self, message, type_dm=False, before=None, text=True, images=True, sighting=None):
         author_id = message.author.id
         responses = []
+        context = ModerationContext(message)
 
         # If we don't currently have an active report for this user, add one
         if author_id not in self.reports:
             self.reports[author_id] = Report(self)
+        report = self.reports[author_id]
 
-        if author_id not in self.warning_count:
-            self.warning_count[author_id] = 0
-        
-        self.message = message
-   
-        
         if type_dm:
             # Let the report class handle this message; forward all the messages it returns to us
-            responses = await self.reports[author_id].handle_message(message)
+            responses = await report.handle_message(message)
 
-            if self.state != State.CONTINUE_REPORT:
+            if report.state != State.CONTINUE_REPORT:
                 for r in responses:
                     await message.channel.send(r)
-                if self.state == State.MESSAGE_IDENTIFIED:
-                    self.original_message = self.message
-                    self.state = State.CONTINUE_REPORT
+                if report.state == State.MESSAGE_IDENTIFIED:
+                    report.state = State.CONTINUE_REPORT
 
-            # if the user inputs any other thing except a valid link to a message they intend to report
-            if self.state and self.state != State.CONTINUE_REPORT:
-                return
+            if report.state == State.CONTINUE_REPORT and report.guild:
+                mod_channel = self.channel_index.mod_channels[report.guild.id]
+                report_reply = report.handle_report_reply(message.content)
+                if report_reply:
+                    # Pass on the bot's own verdict when it still has it, rather than scoring the message again
+                    if report.verdict is not None:
+                        report_reply += f'\nAutomatic verdict: {report.verdict or "not flagged"}'
+                    self.dispatcher.post(mod_channel, self.code_format(f'{report.message.author}:{report.message.content}\n{report_reply}'))
 
-            if self.state == State.CONTINUE_REPORT:
-                self.message = message
-                if self.private_dm_guild:
-                    mod_channel = self.mod_channels[self.private_dm_guild.id]
-                    report_reply = self.reports[author_id].handle_report_reply(message.content)
-                    if report_reply:
-                        await mod_channel.send(self.code_format(f'{self.original_message.author}:{self.original_message.content}\n{report_reply}'))
-                return
+            # DMs only drive the reporting flow, the reported message itself isn't scored here
+            return context
 
 
         # We want to evaluate all messages and check their threshold level
-        scores_all = self.eval_text(self.message)
-        image_score = scores_all[0]
-        
-        threshold_results_img = self.reports[author_id].eval_threshold(image_score)
+        with metrics.span('stage_seconds', stage='score'):
+            scores_all = await self.eval_text(message, before, sighting, text, images)
+        context.scores = scores_all
+        if sighting is not None and sighting.reusable and sighting.entry.scores is None:
+            sighting.entry.scores = scores_all[1]
+        context.image_flagged = scores_all[0] == CSAM_IMAGE_SCORES
         
         # report flow for images
-        if threshold_results_img[0] == 1:
-            self._toxic_state = True
-            threshold_message = self.reports[author_id].perform_toxic_action(threshold_results_img[1], author_id)
-        else:
-            self._toxic_state = False
-            threshold_message = '' 
+        if context.image_flagged:
+            context.thresholds.append('image:CSAM')
+            context.toxic_state = True
+            context.threshold_message = report.perform_toxic_action(CSAM_THRESHOLDS, author_id)
             
         # report flow for text
 
         scores = scores_all[1]
         if scores is not None:
-            threshold_results = self.reports[author_id].eval_threshold(scores)
+            threshold_results = report.eval_threshold(scores, message.guild.id)
+            context.thresholds += [result.name for result in threshold_results[1]]
 
             if threshold_results[0] == 1:
-                self._toxic_state = True
-                threshold_message = self.reports[author_id].perform_toxic_action(threshold_results[1], author_id)
+                context.toxic_state = True
+                context.threshold_message = report.perform_toxic_action(threshold_results[1], author_id)
             elif threshold_results[0] == 2:
-                self._toxic_state = False
-                threshold_message = self.reports[author_id].perform_questionable_action(threshold_results[1])
+                context.toxic_state = False
+                context.threshold_message = report.perform_questionable_action(threshold_results[1])
             else:
-                self._toxic_state = False
-                threshold_message = ''
+                context.toxic_state = False
+                context.threshold_message = ''
+
+        # A flood is spam whatever its scores; the moderators are told but nobody is warned for it
+        if sighting is not None and sighting.flood and not context.threshold_message:
+            context.threshold_message = f'{Type.SPAM_KEYWORD.value} flood: {sighting.flood}'
+            context.thresholds.append('FLOOD')
+            metrics.inc('floods_total')
+
+        # An edit, or an image check after the text was moderated, that flags nothing keeps the earlier verdict.
+        # Text that went unscored (Perspective failed, degraded mode) has no verdict rather than "not flagged"
+        if (before is None and text and scores_all[1] is not None) or context.threshold_message:
+            self.recent.record_verdict(message, scores_all, context.threshold_message)
 
-        if type_dm:
-            return threshold_message
-            
         # Ban a user if he is flagged 3 or more times
         user_ban_message = f'{message.author.name} has been banned from the group'
-        if self.warning_count[author_id] >= 3:
-            self._user_ban_message = user_ban_message
+        if self.store.warning_count(author_id) >= 3:
+            context.user_ban_message = user_ban_message
         
         # If a message is found toxic, we want to delete the message
-        if threshold_results_img[0] == 1:
+        if context.image_flagged:
             try:
-                await message.delete()
-                self._permission_denied = self.code_format(f'The image from {message.author.name} has been removed. Police will be enformed about CSAM content immediately and further steps will be taken if necessary.')
-                self._user_ban_message = user_ban_message
+                with metrics.span('stage_seconds', stage='delete'):
+                    await message.delete()
+                context.permission_denied = self.code_format(f'The image from {message.author.name} has been removed. Police will be enformed about CSAM content immediately and further steps will be taken if necessary.')
+                context.user_ban_message = user_ban_message
+                context.actions.append('delete')
             except discord.errors.Forbidden as e:
                 print('Cannot delete message because ', e)
-                self._permission_denied = "Message cannot be deleted because permission was denied"
+                context.permission_denied = "Message cannot be deleted because permission was denied"
+                context.actions.append('delete_denied')
 
-        if (scores is not None and threshold_results[0] == 1) or self.warning_count[author_id] >= 3:
+        if (scores is not None and threshold_results[0] == 1) or self.store.warning_count(author_id) >= 3:
             try:
-                await message.delete()
-                self._permission_denied = self.code_format(f'The message by {message.author.name} has been removed')
+                with metrics.span('stage_seconds', stage='delete'):
+                    await message.delete()
+                context.permission_denied = self.code_format(f'The message by {message.author.name} has been removed')
+                if 'delete' not in context.actions:
+                    context.actions.append('delete')
             except discord.errors.Forbidden as e:
                 print('Cannot delete message because ', e)
-                self._permission_denied = "Message cannot be deleted because permission was denied"
+                context.permission_denied = "Message cannot be deleted because permission was denied"
+                context.actions.append('delete_denied')
 
-        return threshold_message
-    
-    @property
-    def user_ban_message(self):
-        return self._user_ban_message
+        return context
 
     async def handle_dm(self, message):
         # Handle a help message    
@@ -206,42 +419,69 @@ class ModBot(discord.Client):
 
         author_id = message.author.id
 
+        # Pick up a report that was in progress before a restart
+        if author_id not in self.reports:
+            record = self.store.load_report(author_id)
+            if record:
+                self.reports[author_id] = await Report.from_record(self, record)
+
         # Only respond to messages if they're part of a reporting flow
         if author_id not in self.reports and not message.content.startswith(Report.START_KEYWORD):
             return
 
-        threshold_message = await self.handle_report(message, True)
+        context = await self.handle_report(message, True)
  
         # If the report is complete or cancelled, remove it from our map
         if self.reports[author_id].report_complete():
             self.reports.pop(author_id)
+            self.store.delete_report(author_id)
+        else:
+            self.store.save_report(author_id, self.reports[author_id].to_record())
         
         # Returns the evaluation of the reported message and if the user has been banned or message has been removed
         final_message = ''
 
-        if threshold_message:
-            final_message = threshold_message
+        if context.threshold_message:
+            final_message = context.threshold_message
 
-            if self.user_ban_message:  
-                final_message += f"\n{self.user_ban_message}"
-            if self._permission_denied and self._toxic_state:
-                final_message += f"\n{self._permission_denied}"
+            if context.user_ban_message:  
+                final_message += f"\n{context.user_ban_message}"
+            if context.permission_denied and context.toxic_state:
+                final_message += f"\n{context.permission_denied}"
             await message.channel.send(final_message)
 
 
-    async def handle_channel_message(self, message):
+    async def handle_channel_message(self, message, before=None, text=True, images=True, sighting=None):
         # Only handle messages sent in the "group-#" channel
-        if not message.channel.name == f'group-{self.group_num}':
+        if not self.channel_index.is_monitored(message.channel.id):
             return 
 
+        start = time.perf_counter()
+        context = await self.handle_report(message, before=before, text=text, images=images, sighting=sighting)
+        self.notify(message, context)
+        if self.audit:
+            self.audit.record(guild_id=message.guild.id, channel_id=message.channel.id, message_id=message.id,
+                              user_id=message.author.id, edit=before is not None, scores=context.scores,
+                              thresholds=context.thresholds, actions=context.actions,
+                              latency_ms=round((time.perf_counter() - start) * 1000, 2))
+
+    def remember_image_alert(self, alert, message):
+        self.image_alerts[alert.id] = message.id
+        while len(self.image_alerts) > IMAGE_ALERT_HISTORY:
+            self.image_alerts.popitem(last=False)
+
+    def notify(self, message, context):
+        '''
+        Tells the moderators, the author and the channel what moderation decided about a message.
+        '''
         # Forward the message to the mod channel
-        mod_channel = self.mod_channels[message.guild.id]
+        mod_channel = self.channel_index.mod_channels[message.guild.id]
         
-        response_message = await self.handle_report(message)
+        response_message = context.threshold_message
         if not response_message:
             return
         
-        if self.warning_count[message.author.id] > 3:
+        if self.store.warning_count(message.author.id) > 3:
             return
 
         WARNING_EMOJI = ':bangbang:'
@@ -259,44 +499,73 @@ class ModBot(discord.Client):
         formatted_report += WARN_USER_EMOJI + " - send a " + "**" + "warning " + "**" + "to the user\n\n"
         formatted_report += BAN_USER_EMOJI + " - " + "**" + "ban " + "**" + "the user\n\n"
         formatted_report += RESOLVED_NO_ACTION + " - " + "**" + "resolve " + "**" + "this report\n\n"
-        await mod_channel.send(formatted_report)
+        # Image alerts aren't packed into digests: a reaction on one labels that message's images in the hash index
+        if context.image_flagged:
+            self.dispatcher.post(mod_channel, formatted_report, on_sent=lambda alert: self.remember_image_alert(alert, message), alone=True)
+        else:
+            self.dispatcher.post(mod_channel, formatted_report)
+        context.actions.append('alert')
 
         # Inform user through DM that their message was found violating the platform rules
-        if self._toxic_state:
+        if context.toxic_state:
             warning_count_message = 'The message is not appropriate for this platform. After three counts, \
-you\'ll be banned from the channel\nCurrent count is ' + str(self.warning_count[message.author.id])
-            await message.author.send(self.code_format(f'{message.content}\n{response_message}\n{warning_count_message}'))
+you\'ll be banned from the channel\nCurrent count is ' + str(self.store.warning_count(message.author.id))
+            self.dispatcher.post(message.author, self.code_format(f'{message.content}\n{response_message}\n{warning_count_message}'))
+            context.actions.append('warn')
 
         
         # send the final message to the mod channel
         final_message = ''
         
         # If it is a message it is expected to delete
-        if self._permission_denied and self._toxic_state:
-            await message.channel.send(self._permission_denied)
+        if context.permission_denied and context.toxic_state:
+            self.dispatcher.post(message.channel, context.permission_denied)
 
-        if self.user_ban_message:  
-            final_message = self.user_ban_message
-            await message.channel.send(self.user_ban_message)
+        if context.user_ban_message:  
+            final_message = context.user_ban_message
+            self.dispatcher.post(message.channel, context.user_ban_message)
+            context.actions.append('ban')
 
-        if self.warning_count[message.author.id] == 3:
-            self.warning_count[message.author.id] +=1
+        if self.store.warning_count(message.author.id) == 3:
+            self.store.increment_warning(message.author.id)
         # await mod_channel.send(self.code_format(json.dumps(scores, indent=2)))
 
 
-    def eval_text(self, message):
+    async def eval_text(self, message, before=None, sighting=None, text=True, images=True):
 
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
+        For an edit, only the parts that changed since `before` are scored: new attachments, and the text
+        if it changed. Anything else was already judged and acted on when the message was first seen, so
+        it is left as None rather than judged (and warned about) a second time.
+        A `sighting` from the flood detector lets a near-exact copy of already scored text reuse its scores.
+        `text` or `images` set to False leaves that part unscored, for messages whose text is moderated
+        before their images.
         '''
         output = [None, None]
-        isCSAM = csam.eval_im(message)
-        if isCSAM:
-            output[0] =  {'SEVERE_TOXICITY': 1, 'PROFANITY': 1, 'IDENTITY_ATTACK': 1, 'THREAT': 1, 'TOXICITY':1, 'FLIRTATION': 0.5}
-        else:
-            output[0] = {'SEVERE_TOXICITY': 0, 'PROFANITY': 0, 'IDENTITY_ATTACK': 0, 'THREAT': 0, 'TOXICITY':0, 'FLIRTATION': 0}
-
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+        attachments = message.attachments
+        score_text = True
+        if before is not None:
+            score_text, attachments = self.edit_changes(before, message)
+        score_text = score_text and text
+        # PDFs, audio and images too big to check are skipped before anything is downloaded
+        attachments = image_attachments(attachments) if images else []
+
+        # Without the image models the text is still moderated; the images are counted as skipped
+        isCSAM = False
+        if attachments and self.csam is None:
+            metrics.inc('attachments_skipped_total', value=len(attachments), reason='models_unavailable')
+        elif attachments:
+            try:
+                with metrics.span('stage_seconds', stage='images'):
+                    isCSAM = await self.csam.eval_im(message, attachments)
+            except Exception as e:
+                print('Cannot check images because ', repr(e))
+                metrics.inc('attachments_skipped_total', value=len(attachments), reason='model_error')
+        output[0] = dict(CSAM_IMAGE_SCORES if isCSAM else CLEAN_IMAGE_SCORES)
+
+        if not score_text:
+            return output
 
         if message.content == "":
             return output
@@ -307,30 +576,82 @@ you\'ll be banned from the channel\nCurrent count is ' + str(self.warning_count[
         #         output[1] = {'SEVERE_TOXICITY': 0.681, 'PROFANITY': 0.621, 'IDENTITY_ATTACK': 0.651, 'THREAT': 0.641, 'TOXICITY':0.661, 'FLIRTATION': 0.601}
         #         return output
         
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {'text': message.content},
-            'languages': ['en'],
-            'requestedAttributes': {
-                                    'SEVERE_TOXICITY': {}, 'PROFANITY': {},
-                                    'IDENTITY_ATTACK': {}, 'THREAT': {},
-                                    'TOXICITY': {}, 'FLIRTATION': {}
-                                },
-            'doNotStore': True
-        }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
-
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
-                
-        output[1] = scores
+        # Only go to Perspective if we haven't already scored the same text
+        output[1] = self.score_cache.get(message.content, ATTRIBUTES)
+        if output[1] is not None:
+            return output
+
+        # Spam waves vary their text slightly; a near-exact copy gets the verdict the first copy got, unless
+        # what it changed hit the lexicon
+        if sighting is not None and sighting.reusable and sighting.entry.scores is not None:
+            if not self.prescreen.score(message.content)[1]:
+                metrics.inc('near_duplicates_total')
+                output[1] = sighting.entry.scores
+                return output
+
+        # Clearly benign messages don't need Perspective at all
+        if self.prescreen.is_benign(message.content):
+            metrics.inc('prescreen_total', decision='benign')
+            output[1] = {attr: 0.0 for attr in ATTRIBUTES}
+            return output
+        metrics.inc('prescreen_total', decision='escalated')
+
+        # While the workers are behind, only text that was already scored gets a verdict
+        if self.scheduler.degraded:
+            metrics.inc('perspective_skipped_total')
+            return output
+
+        try:
+            with metrics.span('stage_seconds', stage='perspective'):
+                output[1] = await self.perspective.score(message.content)
+            self.score_cache.put(message.content, ATTRIBUTES, output[1])
+        except PerspectiveError as e:
+            print('Cannot score message because ', e)
         return output
     
     def code_format(self, text):
         return "```" + text + "```"
             
         
-client = ModBot(perspective_key)
-client.run(discord_token)
+def load_tokens():
+    # There should be a file called 'token.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        return tokens['discord'], tokens['perspective']
+
+
+# The image model pool spawns worker processes that re-import this module, so only run the bot from here
+if __name__ == '__main__':
+    # Set up logging to discord.log. Records are only queued on the event loop thread (DEBUG ones sampled)
+    # and written by a listener thread; the file rotates instead of being wiped on every restart
+    logger = logging.getLogger('discord')
+    logger.setLevel(logging.DEBUG)
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(DEBUG_LOG_SAMPLE))
+    logger.addHandler(queue_handler)
+    handler = logging.handlers.RotatingFileHandler(filename='discord.log', encoding='utf-8', maxBytes=32 * 1024 * 1024, backupCount=5)
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    parser = argparse.ArgumentParser(description='Run the moderation bot.')
+    parser.add_argument('--shard-count', type=int, default=SHARD_COUNT, help='total shards across every process')
+    parser.add_argument('--shard-ids', type=int, nargs='+', default=SHARD_IDS, help='shards this process runs')
+    args = parser.parse_args()
+    if args.shard_ids and not args.shard_count:
+        parser.error('--shard-ids needs --shard-count')
+    if args.shard_ids and 0 in args.shard_ids and len(args.shard_ids) < args.shard_count:
+        print('Warning: DM reports about messages in guilds on other processes will be rejected')
+
+    discord_token, perspective_key = load_tokens()
+    client = ModBot(perspective_key, shard_count=args.shard_count, shard_ids=args.shard_ids)
+    try:
+        # log_handler=None keeps discord.py from replacing the logging set up above with its own stderr handler
+        client.run(discord_token, log_handler=None)
+    finally:
+        listener.stop()
@@ -0,0 +1,61 @@
+import asyncio
+from metrics import metrics
+
+
+class Stage:
+    '''
+    One condition of a cascade. `run` is a coroutine function that scores an item and `passes` decides
+    whether that score satisfies the condition.
+    '''
+
+    def __init__(self, name, run, passes):
+        self.name = name
+        self.run = run
+        self.passes = passes
+
+
+class Cascade:
+    '''
+    Evaluates a conjunction of stages in order, so the cheapest stage should come first. As soon as one
+    stage fails the answer is decided and the remaining stages are skipped.
+    '''
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.stats = {stage.name: {'runs': 0, 'skips': 0} for stage in self.stages}
+
+    async def evaluate(self, item):
+        for i, stage in enumerate(self.stages):
+            self.stats[stage.name]['runs'] += 1
+            with metrics.span('image_stage_seconds', stage=stage.name):
+                value = await stage.run(item)
+            if not stage.passes(value):
+                for skipped in self.stages[i + 1:]:
+                    self.stats[skipped.name]['skips'] += 1
+                return False
+        return True
+
+    def skip_rates(self):
+        '''
+        Returns the fraction of items for which each stage didn't have to run.
+        '''
+        rates = {}
+        for name, stats in self.stats.items():
+            total = stats['runs'] + stats['skips']
+            rates[name] = stats['skips'] / total if total else 0.0
+        return rates
+
+
+async def any_true(aws):
+    '''
+    Runs the awaitables concurrently and returns True as soon as one of them does, cancelling the rest.
+    '''
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            if await next_done:
+                return True
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,43 @@
+class ChannelIndex:
+    '''
+    The channels the bot moderates (group-#) and reports to (group-#-mod), keyed by id so routing a
+    message is a dict lookup. Each guild is scanned once when it becomes available; after that the index
+    follows channel create, rename and delete events instead of rescanning.
+    '''
+
+    def __init__(self, group_num):
+        self.monitored_name = f'group-{group_num}'
+        self.mod_name = f'group-{group_num}-mod'
+        self.monitored = {} # Map from channel id to a channel the bot moderates
+        self.mod_channels = {} # Map from guild id to the mod channel for that guild
+        self._by_guild = {} # Map from guild id to the ids of its monitored channels
+
+    def is_monitored(self, channel_id):
+        return channel_id in self.monitored
+
+    def add_guild(self, guild):
+        for channel in guild.text_channels:
+            self.update_channel(channel)
+
+    def remove_guild(self, guild):
+        self.mod_channels.pop(guild.id, None)
+        for channel_id in self._by_guild.pop(guild.id, ()):
+            self.monitored.pop(channel_id, None)
+
+    def update_channel(self, channel):
+        '''
+        Indexes a channel that was created or renamed, and drops it if it no longer has a group name.
+        '''
+        self.remove_channel(channel)
+        if channel.name == self.monitored_name:
+            self.monitored[channel.id] = channel
+            self._by_guild.setdefault(channel.guild.id, set()).add(channel.id)
+        elif channel.name == self.mod_name:
+            self.mod_channels[channel.guild.id] = channel
+
+    def remove_channel(self, channel):
+        self.monitored.pop(channel.id, None)
+        self._by_guild.get(channel.guild.id, set()).discard(channel.id)
+        mod_channel = self.mod_channels.get(channel.guild.id)
+        if mod_channel is not None and mod_channel.id == channel.id:
+            del self.mod_channels[channel.guild.id]
@@ -1,16 +1,22 @@
-from nudenet import NudeClassifier
-from pyagender import PyAgender
-import hmtai
+import cv2
 
-classifier = NudeClassifier()
+# Built on first use, so importing this module doesn't load TensorFlow
+classifier = None
 
 
+def get_classifier():
+	global classifier
+	if classifier is None:
+		from nudenet import NudeClassifier
+		classifier = NudeClassifier()
+	return classifier
 
 def nude_class(filename):
-	nude_results = classifier.classify(filename)
+	nude_results = get_classifier().classify(filename)
 	return nude_results[filename]['unsafe']
 
 def age_class(filename):
+	from pyagender import PyAgender
 	agender = PyAgender() 
 	# see available options in __init__() src
 	faces = agender.detect_genders_ages(cv2.imread(filename))
@@ -0,0 +1,16 @@
+class ModerationContext:
+    '''
+    Everything handle_report works out about a single message. Each message gets its own context, so
+    messages being moderated at the same time can't overwrite each other's results.
+    '''
+
+    def __init__(self, message):
+        self.message = message
+        self.threshold_message = ''
+        self.toxic_state = False
+        self.permission_denied = None
+        self.user_ban_message = None
+        self.scores = None # [image scores, text scores] from eval_text
+        self.thresholds = [] # Names of the thresholds the message crossed
+        self.actions = [] # What the bot did about it, for the audit log
+        self.image_flagged = False # Whether the image cascade flagged one of its attachments
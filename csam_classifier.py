@@ -5,53 +5,144 @@
 # !pip install hmtai
 # !pip install wget
 # !pip3 install tensorflow==1.10
-from nudenet import NudeClassifier
-from pyagender import PyAgender
-import hmtai
-import urllib.request
-import wget
-import tensorflow as tf
-import keras
-import cv2
-import os
-import requests
+import asyncio
+from collections import OrderedDict
+from model_pool import ModelPool, get_backend
+from attachments import AttachmentFetcher, AttachmentError, decode_image, image_attachments, download_url, scaled_size
+from backends import nude_input
+from phash import HashIndex, array_hashes, FLAGGED, CLEARED
+from cascade import Cascade, Stage, any_true
+from batching import MicroBatcher
+from metrics import metrics
+
+# The models are loaded once per worker process and kept resident; bot.py starts the pool in its background warm-up
+# BACKEND picks how they run: 'default' (nudenet and PyAgender as shipped), 'onnx' or 'onnx-int8'; see backends.py
+BACKEND = 'default'
+pool = ModelPool(backend=BACKEND)
+fetcher = AttachmentFetcher()
+
+# Images we've already judged, so reposts skip the models entirely
+HASH_INDEX_PATH = 'image_hashes.bin'
+index = HashIndex(HASH_INDEX_PATH)
+
+# Hashes of recently checked messages, kept until a moderator rules on them
+MAX_RECENT_HASHES = 10000
+recent_hashes = OrderedDict()
 
 # classifies an image and finds the minimum age of all people present in the image
-def age_class(filename):
-  agender = PyAgender() 
-  faces = agender.detect_genders_ages(cv2.imread(filename))
+def age_class(image):
   min_age = 200
-  for face in faces:
-    curr_age = face['age']
+  for curr_age in get_backend().face_ages(image):
     min_age = min(curr_age, min_age)
   print("The minimum age found was: " + str(min_age))
   return min_age
 
 # classifies an image to contain nudity with a specific probability betwee 0 and 1
-def nude_class(filename):
-  classifier = NudeClassifier()
-  nude_results = classifier.classify(filename)
-  nude_prob = nude_results[filename]['unsafe']
+def nude_class(image):
+  nude_prob = get_backend().nude_scores([image])[0]
   print("The probability that nudity is present in this image is: " + str(nude_prob))
-  return nude_results[filename]['unsafe']
-
-# determines whether an image is considered CSAM, return True if CSAM and False otherwise
-def is_csam(url):
-  print("THIS IS URL: ",url)
-  # filename = wget.download(url)
-  r = requests.get(url, stream=True)
-  filename = "CSAM/" + url.split('/')[-1]
-  open(filename, 'wb').write(r.content)
-  age = age_class(filename)
-  nude_prob = nude_class(filename)  
-  csam = nude_prob > 0.8 and age < 18
-  os.remove(filename)
-  return csam
-
-def eval_im(message):
-  if len(message.attachments) > 0:
-    image_url = message.attachments[0].url
-    if is_csam(image_url):
-      # do report flow thing
-      return True
+  return nude_prob
+
+# an image is considered CSAM when both of these hold
+NUDE_THRESHOLD = 0.8
+AGE_THRESHOLD = 18
+
+# batched entry points for the cascade, run inside a pool worker on arrays decoded by eval_attachment;
+# the nudity model classifies the whole batch in one pass
+def nude_scores(images):
+  return get_backend().nude_scores(images)
+
+async def _run_nude_batch(images):
+  return await pool.run(nude_scores, images)
+
+# images from concurrent eval_im calls are grouped into batches before reaching the nudity model
+nude_batcher = MicroBatcher(_run_nude_batch, max_batch_size=8, max_wait=0.02)
+
+# the nudity model only ever sees its 256x256 input, so only that much is sent to the pool;
+# the full array only goes to the age stage, for the few images that get that far
+async def run_nude_stage(image):
+  return await nude_batcher.submit(nude_input(image))
+
+# the age model has no batch API, so batching would only run full-size images one after another in one
+# worker; each image is its own job, so concurrent ones spread across the workers
+async def run_age_stage(image):
+  return await pool.run(age_class, image)
+
+# nudity is a single classifier pass while the age stage runs face detection and then a model per face,
+# so nudity goes first; most images fail it and never reach the age model
+cascade = Cascade([
+  Stage('nudity', run_nude_stage, lambda nude_prob: nude_prob > NUDE_THRESHOLD),
+  Stage('age', run_age_stage, lambda age: age < AGE_THRESHOLD),
+])
+
+# fetches the scaled-down copy of a big image when there is one, falling back to the original if the proxy can't serve it
+async def download(attachment):
+  url = download_url(attachment)
+  if url != attachment.url:
+    try:
+      data = await fetcher.fetch(url)
+      if attachment.size and attachment.size > len(data):
+        metrics.inc('attachment_bytes_saved_total', value=attachment.size - len(data), reason='scaled')
+      return data
+    except AttachmentError as e:
+      print('Cannot download scaled-down attachment, fetching the original because ', e)
+  return await fetcher.fetch(attachment.url)
+
+# checks a single attachment, using the hash index before falling back to the models
+async def eval_attachment(message_id, attachment):
+  print("THIS IS URL: ",attachment.url)
+  try:
+    with metrics.span('image_stage_seconds', stage='download'):
+      data = await download(attachment)
+  except AttachmentError as e:
+    print('Cannot download attachment because ', e)
+    return False
+
+  # whichever copy was fetched, nothing bigger than the models need is decoded
+  fitted = scaled_size(attachment.width, attachment.height)
+  if fitted is not None:
+    metrics.inc('attachment_pixels_saved_total', value=attachment.width * attachment.height - fitted[0] * fitted[1])
+
+  # the image is decoded once, off the event loop; the hash and both model stages share the array
+  with metrics.span('image_stage_seconds', stage='decode'):
+    image = await asyncio.to_thread(decode_image, data)
+  if image is None:
+    return False
+
+  with metrics.span('image_stage_seconds', stage='hash'):
+    hashes = await asyncio.to_thread(array_hashes, image)
+  known = index.lookup(hashes)
+  metrics.inc('hash_index_lookups_total', result='miss' if known is None else 'hit')
+  if known is not None:
+    if known == FLAGGED:
+      remember_hashes(message_id, hashes)
+    return known == FLAGGED
+
+  if await cascade.evaluate(image):
+    # only flagged images are remembered automatically; clearing an image is left to a moderator
+    index.add(hashes, FLAGGED)
+    remember_hashes(message_id, hashes)
+    return True
   return False
+
+# checks every image attachment of a message concurrently and stops as soon as one is flagged
+# pass `attachments` to check only some of them, e.g. the image attachments an edit added
+async def eval_im(message, attachments=None):
+  if attachments is None:
+    attachments = image_attachments(message.attachments)
+  if not attachments:
+    return False
+  return await any_true(eval_attachment(message.id, attachment) for attachment in attachments)
+
+# only the attachments that were flagged are remembered, so a moderator's decision on the alert says nothing
+# about the other images that happened to be posted with them
+def remember_hashes(message_id, hashes):
+  recent_hashes.setdefault(message_id, []).append(hashes)
+  recent_hashes.move_to_end(message_id)
+  while len(recent_hashes) > MAX_RECENT_HASHES:
+    recent_hashes.popitem(last=False)
+
+# records a moderator's decision on a message's images so near-duplicates are resolved without the models
+def record_decision(message_id, flagged):
+  for hashes in recent_hashes.pop(message_id, []):
+    index.add(hashes, FLAGGED if flagged else CLEARED)
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from collections import deque
+from metrics import metrics
+
+# Discord rejects messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+
+
+class TokenBucket:
+    '''
+    Allows `rate` sends every `per` seconds, with bursts of up to `rate`.
+    '''
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    '''
+    Splits text into pieces Discord will accept, at line breaks where possible.
+    '''
+    pieces = []
+    while len(text) > max_length:
+        cut = text.rfind('\n', 0, max_length)
+        if cut <= 0:
+            cut = max_length
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+class Dispatcher:
+    '''
+    Sends messages in the background so moderation never waits on Discord. Each destination (a channel or
+    a user's DMs) has its own queue and sender task. Messages posted within `window` seconds of each other
+    are packed into as few Discord messages as fit, and a token bucket per destination keeps the sender
+    under Discord's per-channel rate limit instead of running into it.
+    '''
+
+    def __init__(self, window=1.0, rate=5, per=5.0, max_length=MAX_MESSAGE_LENGTH):
+        self.window = window
+        self.rate = rate
+        self.per = per
+        self.max_length = max_length
+        self._pending = {} # Map from destination id to a deque of (content, on_sent, alone)
+        self._senders = {} # Map from destination id to its sender task
+        self._buckets = {}
+        self.stats = {'posted': 0, 'sent': 0}
+
+    def post(self, destination, content, on_sent=None, alone=False):
+        '''
+        Queues `content` for `destination` and returns immediately. `on_sent` is called with each Discord
+        message it ended up in, which may also contain other posts unless `alone` is set, in which case it
+        is never packed with anything else.
+        '''
+        key = destination.id
+        self._pending.setdefault(key, deque()).append((content, on_sent, alone))
+        self.stats['posted'] += 1
+        if key not in self._senders:
+            self._buckets.setdefault(key, TokenBucket(self.rate, self.per))
+            self._senders[key] = asyncio.create_task(self._send_loop(destination))
+
+    def pending(self):
+        return sum(len(queue) for queue in self._pending.values())
+
+    def _next_batch(self, queue):
+        # Take posts off the queue until the next one would push the digest over the length limit
+        batch = [queue.popleft()]
+        if batch[0][2]:
+            return batch
+        length = len(batch[0][0])
+        while queue and not queue[0][2] and length + 1 + len(queue[0][0]) <= self.max_length:
+            length += 1 + len(queue[0][0])
+            batch.append(queue.popleft())
+        return batch
+
+    async def _send_loop(self, destination):
+        key = destination.id
+        queue = self._pending[key]
+        bucket = self._buckets[key]
+        try:
+            while queue:
+                # Give a burst of alerts a moment to arrive so they go out as one digest
+                await asyncio.sleep(self.window)
+                while queue:
+                    batch = self._next_batch(queue)
+                    sent = []
+                    for piece in split_message('\n'.join(content for content, _, _ in batch), self.max_length):
+                        await bucket.acquire()
+                        try:
+                            with metrics.span('dispatcher_send_seconds'):
+                                sent.append(await destination.send(piece))
+                            self.stats['sent'] += 1
+                            metrics.inc('dispatcher_messages_total')
+                        except Exception as e:
+                            print('Cannot send message because ', e)
+                    metrics.inc('dispatcher_posts_total', value=len(batch))
+                    for _, on_sent, _ in batch:
+                        if on_sent:
+                            for message in sent:
+                                on_sent(message)
+        finally:
+            del self._senders[key]
+            if not queue:
+                del self._pending[key]
+
+    async def drain(self):
+        '''
+        Waits until everything posted so far has been sent.
+        '''
+        while self._senders:
+            await asyncio.gather(*self._senders.values(), return_exceptions=True)
+
+    async def close(self, timeout=10):
+        '''
+        Gives what is still queued up to `timeout` seconds to go out, then stops the senders.
+        '''
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f'Cannot send {self.pending()} queued messages before shutting down')
+        for task in list(self._senders.values()):
+            task.cancel()
@@ -0,0 +1,190 @@
+'''
+Offline evaluation of the CSAM image classifiers over a local labelled directory.
+
+    python evaluate.py path/to/dataset [--workers 4] [--sweep] [--max-side 0]
+
+The dataset directory holds one sub-directory per label: images under `positive/` should be flagged and
+images under `negative/` should not. Model outputs are cached per image content in `--cache`, so changing
+thresholds or re-running with `--sweep` only runs inference on images that haven't been seen before.
+Images are decoded no bigger than the bot decodes them; `--max-side 0` scores them at full resolution,
+so comparing the two runs shows what the downscaling costs in recall.
+'''
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import csam_classifier as csam
+from attachments import decode_image, TARGET_SIZE
+from model_pool import load_models
+
+LABELS = {'positive': True, 'negative': False}
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png')
+
+
+def find_images(dataset_dir):
+    images = []
+    for label_dir, label in LABELS.items():
+        path = os.path.join(dataset_dir, label_dir)
+        if not os.path.isdir(path):
+            continue
+        for filename in sorted(os.listdir(path)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                images.append((os.path.join(path, filename), label))
+    return images
+
+
+def content_key(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def score_image(path, max_side=TARGET_SIZE):
+    '''
+    Runs both models over one image inside a pool worker and times each stage.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    # nude_class and age_class print every result, which is just noise across a whole dataset
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        image = decode_image(data, max_side or None)
+        decoded = time.perf_counter()
+        if image is None:
+            return None
+        nude_prob = float(csam.nude_class(image))
+        nude_done = time.perf_counter()
+        age = float(csam.age_class(image))
+        age_done = time.perf_counter()
+    return {
+        'nude_prob': nude_prob,
+        'age': age,
+        'timings': {'decode': decoded - start, 'nudity': nude_done - decoded, 'age': age_done - nude_done},
+    }
+
+
+def wait_for_workers(barrier):
+    '''
+    Holds a worker until every worker is running this too. A worker only takes a job once its initializer has
+    loaded the models, so one of these per worker returns once they are all loaded.
+    '''
+    barrier.wait()
+
+
+class OutputCache:
+    '''
+    Model outputs keyed by a hash of the image bytes.
+    '''
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, result TEXT)')
+
+    def get(self, key):
+        row = self._db.execute('SELECT result FROM outputs WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, result):
+        self._db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)', (key, json.dumps(result)))
+        self._db.commit()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def precision_recall(results, nude_threshold, age_threshold):
+    tp = fp = fn = 0
+    for result, label in results:
+        predicted = result['nude_prob'] > nude_threshold and result['age'] < age_threshold
+        tp += predicted and label
+        fp += predicted and not label
+        fn += not predicted and label
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return precision, recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dataset_dir')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='inference processes')
+    parser.add_argument('--cache', default='eval_cache.db', help='where model outputs are cached')
+    parser.add_argument('--nude-threshold', type=float, default=csam.NUDE_THRESHOLD)
+    parser.add_argument('--age-threshold', type=float, default=csam.AGE_THRESHOLD)
+    parser.add_argument('--sweep', action='store_true', help='also report a grid of nearby thresholds')
+    parser.add_argument('--max-side', type=int, default=TARGET_SIZE,
+                        help='longest side images are decoded at, 0 for full resolution (default: what the bot uses)')
+    args = parser.parse_args()
+
+    images = find_images(args.dataset_dir)
+    if not images:
+        raise SystemExit(f'No labelled images found under {args.dataset_dir}/positive or /negative')
+
+    cache = OutputCache(args.cache)
+    results = []
+    missing = []
+    for path, label in images:
+        # Outputs depend on the size the image was decoded at as well as its content
+        key = f'{content_key(path)}:{args.max_side}'
+        result = cache.get(key)
+        if result is None:
+            missing.append((path, label, key))
+        else:
+            results.append((result, label))
+    print(f'{len(images)} images, {len(images) - len(missing)} cached, {len(missing)} to score')
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=load_models,
+                                 initargs=(csam.BACKEND,)) as executor:
+            # Process start-up and model loading aren't part of the throughput
+            with multiprocessing.Manager() as manager:
+                barrier = manager.Barrier(args.workers)
+                for future in [executor.submit(wait_for_workers, barrier) for _ in range(args.workers)]:
+                    future.result()
+            start = time.perf_counter()
+            futures = {executor.submit(score_image, path, args.max_side): (path, label, key) for path, label, key in missing}
+            for future in as_completed(futures):
+                path, label, key = futures[future]
+                result = future.result()
+                if result is None:
+                    print(f'Skipping {path}: not a readable image')
+                    continue
+                cache.put(key, result)
+                results.append((result, label))
+            elapsed = time.perf_counter() - start
+        print(f'Scored {len(missing)} images in {elapsed:.1f}s ({len(missing) / elapsed:.2f} images/s, '
+              f'{args.workers} workers, models already loaded)')
+
+    if not results:
+        raise SystemExit('None of the images could be read')
+
+    print('\nPer-stage latency (ms):')
+    for stage in ('decode', 'nudity', 'age'):
+        samples = [result['timings'][stage] * 1000 for result, _ in results]
+        print(f'  {stage:>7}: p50 {percentile(samples, 50):8.1f}  p95 {percentile(samples, 95):8.1f}  '
+              f'p99 {percentile(samples, 99):8.1f}')
+
+    precision, recall = precision_recall(results, args.nude_threshold, args.age_threshold)
+    print(f'\nnudity > {args.nude_threshold} and age < {args.age_threshold}: '
+          f'precision {precision:.3f}  recall {recall:.3f}')
+
+    if args.sweep:
+        print('\nnudity  age  precision  recall')
+        for nude_threshold in (0.5, 0.6, 0.7, 0.8, 0.9, 0.95):
+            for age_threshold in (14, 16, 18, 20, 22):
+                precision, recall = precision_recall(results, nude_threshold, age_threshold)
+                print(f'{nude_threshold:>6} {age_threshold:>4} {precision:>10.3f} {recall:>7.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import zlib
+from collections import OrderedDict, deque
+import numpy as np
+from prescreen import normalize
+
+# MinHash signature length, split into BANDS bands of NUM_PERM // BANDS rows for LSH
+NUM_PERM = 64
+BANDS = 16
+SHINGLE = 5
+
+# Texts shorter than this (after normalizing) are too generic to call near-duplicates
+MIN_LENGTH = 20
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(152)
+_A = _rng.randint(1, _PRIME, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, size=NUM_PERM).astype(np.uint64)
+
+
+def minhash(text):
+    '''
+    MinHash signature of the character shingles of normalized text, or None if the text is too short.
+    '''
+    text = normalize(text)
+    if len(text) < MIN_LENGTH:
+        return None
+    shingles = {zlib.crc32(text[i:i + SHINGLE].encode()) for i in range(len(text) - SHINGLE + 1)}
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % np.uint64(_PRIME)
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % np.uint64(_PRIME)).min(axis=1)
+
+
+class WindowCounter:
+    '''
+    Counts events per key over the last `window` seconds, kept as `buckets` slices per key so a key costs
+    at most that many entries however busy it is. Keys that go quiet are pruned.
+    '''
+
+    def __init__(self, window, buckets=10):
+        self.window = window
+        self.buckets = buckets
+        self.width = window / buckets
+        self._counts = {} # Map from key to a deque of [slice number, count]
+        self._adds = 0
+
+    def add(self, key, now):
+        slices = self._counts.setdefault(key, deque())
+        # Messages can arrive slightly out of order; a late one counts in the newest slice
+        current = max(int(now / self.width), slices[-1][0]) if slices else int(now / self.width)
+        if slices and slices[-1][0] == current:
+            slices[-1][1] += 1
+        else:
+            slices.append([current, 1])
+        while slices[0][0] <= current - self.buckets:
+            slices.popleft()
+
+        self._adds += 1
+        if self._adds % 1000 == 0:
+            self.prune(now)
+        return sum(count for _, count in slices)
+
+    def prune(self, now):
+        oldest = int(now / self.width) - self.buckets
+        self._counts = {key: slices for key, slices in self._counts.items() if slices[-1][0] > oldest}
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class Entry:
+    __slots__ = ('signature', 'scores', 'created')
+
+    def __init__(self, signature, created):
+        self.signature = signature
+        self.scores = None # Perspective scores of the first copy, once they arrive
+        self.created = created
+
+
+class Sighting:
+    '''
+    What the detector made of one message: the index entry it is a copy of (or that it started), and
+    why it looks like a flood, if it does. `reusable` is whether the message is close enough to the
+    entry's text to share its scores.
+    '''
+    __slots__ = ('entry', 'flood', 'reusable')
+
+    def __init__(self, entry, flood, reusable=False):
+        self.entry = entry
+        self.flood = flood
+        self.reusable = reusable
+
+
+class FloodDetector:
+    '''
+    Streaming spam detection. Recent distinct texts are kept in a MinHash LSH index, so a message whose
+    text is at least `similarity` similar to one already seen is counted as a copy of it, and one at least
+    `reuse_similarity` similar may reuse its scores; a looser match is only counted, since changing a few
+    words is enough to turn a benign text toxic. Sliding-window counters track how fast each user posts and how many copies of each text land
+    in each channel; a message is a flood when either goes over its limit. The index holds at most
+    `max_entries` texts for at most `ttl` seconds, so memory stays bounded.
+    '''
+
+    def __init__(self, window=30, user_limit=10, duplicate_limit=5, similarity=0.7, reuse_similarity=0.9,
+                 max_entries=20000, ttl=3600):
+        self.user_limit = user_limit
+        self.duplicate_limit = duplicate_limit
+        self.similarity = similarity
+        self.reuse_similarity = reuse_similarity
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.user_rate = WindowCounter(window)
+        self.copies = WindowCounter(window)
+        self._entries = OrderedDict() # Map from entry id to Entry, oldest first
+        self._bands = [{} for _ in range(BANDS)] # Per band, map from band hash to the ids of entries with it
+        self._next_id = 0
+        self.stats = {'copies': 0, 'floods': 0}
+
+    def _band_keys(self, signature):
+        rows = NUM_PERM // BANDS
+        return [signature[i * rows:(i + 1) * rows].tobytes() for i in range(BANDS)]
+
+    def _expire(self, now):
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - entry.created <= self.ttl:
+                break
+            del self._entries[entry_id]
+            for band, key in zip(self._bands, self._band_keys(entry.signature)):
+                ids = band.get(key)
+                if ids is not None:
+                    ids.discard(entry_id)
+                    if not ids:
+                        del band[key]
+
+    def _find(self, signature):
+        candidates = set()
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            candidates.update(band.get(key, ()))
+        if not candidates:
+            return None, 0.0
+        candidates = list(candidates)
+        signatures = np.stack([self._entries[entry_id].signature for entry_id in candidates])
+        similarities = (signatures == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        if similarities[best] < self.similarity:
+            return None, 0.0
+        return candidates[best], float(similarities[best])
+
+    def _add(self, signature, now):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = Entry(signature, now)
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            band.setdefault(key, set()).add(entry_id)
+        self._expire(now)
+        return entry_id
+
+    def observe(self, message, now=None):
+        '''
+        Counts a new message and returns a Sighting, or None if its text is too short to index and it
+        isn't part of a flood either. Rates are measured by when messages were posted, not when they are seen.
+        '''
+        now = message.created_at.timestamp() if now is None else now
+        flood = None
+        if self.user_rate.add(message.author.id, now) == self.user_limit + 1:
+            flood = f'{message.author.name} sent more than {self.user_limit} messages in {self.user_rate.window}s'
+
+        signature = minhash(message.content)
+        if signature is None:
+            return Sighting(None, flood) if flood else None
+
+        entry_id, similarity = self._find(signature)
+        if entry_id is None:
+            entry_id = self._add(signature, now)
+            similarity = 1.0
+        else:
+            self.stats['copies'] += 1
+        copies = self.copies.add((message.channel.id, entry_id), now)
+        if copies == self.duplicate_limit and flood is None:
+            flood = f'{copies} near-identical messages in {self.copies.window}s'
+
+        # Only the message that crosses a limit is flagged, so a flood raises one alert rather than one per copy
+        if flood:
+            self.stats['floods'] += 1
+        return Sighting(self._entries[entry_id], flood, similarity >= self.reuse_similarity)
+
+    def __len__(self):
+        return len(self._entries)
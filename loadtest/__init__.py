@@ -0,0 +1,6 @@
+'''
+Load testing for ModBot without Discord, the Perspective API or real traffic.
+
+    python -m loadtest.run --messages 5000 --rate 200
+    python -m loadtest.run --replay traffic.jsonl.gz --speed 20
+'''
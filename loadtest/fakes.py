@@ -0,0 +1,101 @@
+import itertools
+import time
+from datetime import datetime, timezone
+
+# Discord snowflakes are unique per object; these just need to be unique per run
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, name, id=None, bot=False):
+        self.id = id if id is not None else next_id()
+        self.name = name
+        self.bot = bot
+        self.sent = []
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content):
+        # A DM from the bot; there is no DM channel to attach it to
+        message = FakeMessage(content, None, None)
+        self.sent.append(message)
+        return message
+
+
+class FakeGuild:
+    def __init__(self, name, id=None):
+        self.id = id if id is not None else next_id()
+        self.name = name
+        self.text_channels = []
+
+    def add_channel(self, name, id=None):
+        channel = FakeChannel(name, self, id=id)
+        self.text_channels.append(channel)
+        return channel
+
+    def get_channel(self, channel_id):
+        for channel in self.text_channels:
+            if channel.id == channel_id:
+                return channel
+        return None
+
+
+class FakeChannel:
+    def __init__(self, name, guild, id=None):
+        self.id = id if id is not None else next_id()
+        self.name = name
+        self.guild = guild
+        self.sent = []
+        self.bot_user = None
+        self.messages = [] # Channel history, oldest first
+
+    async def send(self, content):
+        message = FakeMessage(content, self.bot_user, self)
+        self.sent.append(message)
+        return message
+
+    async def history(self, limit=None, after=None, oldest_first=True):
+        messages = [m for m in self.messages if after is None or m.id > after.id]
+        if not oldest_first:
+            messages.reverse()
+        for message in messages[:limit]:
+            yield message
+
+
+class FakeAttachment:
+    def __init__(self, url, filename='image.png', content_type='image/png', size=0, width=None, height=None, id=None):
+        self.id = id if id is not None else next_id()
+        self.url = url
+        self.proxy_url = url
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.width = width
+        self.height = height
+
+
+class FakeMessage:
+    '''
+    Enough of discord.Message for the moderation paths. `received_at` is when the message was handed to
+    the bot, so the harness can measure end-to-end latency.
+    '''
+
+    def __init__(self, content, author, channel, attachments=None, id=None):
+        self.id = id if id is not None else next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel is not None else None
+        self.attachments = attachments or []
+        self.created_at = datetime.now(timezone.utc)
+        self.edited_at = None
+        self.deleted = False
+        self.received_at = time.perf_counter()
+
+    async def delete(self):
+        self.deleted = True
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+from collections import deque
+import json
+import random
+from aiohttp import web
+
+# Words that push the mock's scores up, so some synthetic traffic crosses the moderation thresholds
+TOXIC_WORDS = {'idiot', 'stupid', 'hate', 'kill', 'trash', 'loser', 'shut', 'dumb'}
+
+
+def mock_scores(text, attributes):
+    '''
+    Deterministic stand-in scores: a small per-text jitter plus a bump for every toxic word.
+    '''
+    words = set(text.lower().split())
+    base = min(0.95, 0.3 * len(words & TOXIC_WORDS))
+    jitter = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:4], 16) / 0xffff * 0.1
+    return {attr: min(1.0, base + jitter) for attr in attributes}
+
+
+class MockPerspective:
+    '''
+    Local HTTP server that answers like the Perspective analyze endpoint. Each request waits `latency`
+    seconds on average (exponentially distributed) and fails with 429 or 503 at `error_rate`. Failures
+    carry a Retry-After header of `retry_after` seconds when it is set. `fail_next` scripts the next
+    responses exactly, for checking how the client handles them.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, error_rate=0.0, retry_after=None, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'errors': 0}
+        self._script = deque()
+        self._runner = None
+
+    def fail_next(self, *responses):
+        '''
+        Answers the next requests, one each, with these HTTP statuses instead of scores. A number of seconds
+        given as a float makes that request stall that long first and then answer normally.
+        '''
+        self._script.extend(responses)
+
+    def _error(self, status):
+        self.stats['errors'] += 1
+        headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else None
+        return web.Response(status=status, headers=headers)
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/v1alpha1/comments:analyze'
+
+    async def analyze(self, request):
+        self.stats['requests'] += 1
+        # Read before waiting, so a client that gave up by then doesn't leave a half-read request behind
+        body = json.loads(await request.text())
+        scripted = self._script.popleft() if self._script else None
+        if isinstance(scripted, int):
+            return self._error(scripted)
+        if scripted is not None:
+            await asyncio.sleep(scripted)
+        elif self.latency:
+            await asyncio.sleep(self.random.expovariate(1 / self.latency))
+        if scripted is None and self.random.random() < self.error_rate:
+            return self._error(self.random.choice((429, 503)))
+
+        scores = mock_scores(body['comment']['text'], body['requestedAttributes'])
+        return web.json_response({
+            'attributeScores': {attr: {'summaryScore': {'value': value, 'type': 'PROBABILITY'}}
+                                for attr, value in scores.items()},
+            'languages': ['en'],
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1alpha1/comments:analyze', self.analyze)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Port 0 asks the OS for a free port; read back the one we got
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,131 @@
+'''
+Checks PerspectiveClient's retry, backoff and timeout handling against the local mock Perspective server.
+Each check scripts the server's next responses and asserts what the client made of them.
+
+    python -m loadtest.perspective_check
+'''
+import asyncio
+import time
+
+from perspective import PerspectiveClient, PerspectiveError
+from .mock_perspective import MockPerspective
+
+
+def client_for(mock, **kwargs):
+    kwargs.setdefault('backoff', 0.01)
+    client = PerspectiveClient('loadtest', **kwargs)
+    client.url = mock.url
+    return client
+
+
+async def requests_during(mock, coroutine):
+    before = mock.stats['requests']
+    result = await coroutine
+    return result, mock.stats['requests'] - before
+
+
+async def check_retries_until_success(mock):
+    client = client_for(mock)
+    mock.fail_next(429, 503)
+    scores, requests = await requests_during(mock, client.score('hello there'))
+    await client.close()
+    assert 'TOXICITY' in scores and requests == 3, (scores, requests)
+
+
+async def check_gives_up(mock):
+    client = client_for(mock, max_retries=2)
+    mock.fail_next(503, 503, 503)
+    before = mock.stats['requests']
+    try:
+        await client.score('hello there')
+        raise AssertionError('expected PerspectiveError')
+    except PerspectiveError:
+        pass
+    finally:
+        await client.close()
+    assert mock.stats['requests'] - before == 3, mock.stats['requests'] - before
+
+
+async def check_no_retry_on_client_error(mock):
+    client = client_for(mock)
+    mock.fail_next(400)
+    before = mock.stats['requests']
+    try:
+        await client.score('hello there')
+        raise AssertionError('expected PerspectiveError')
+    except PerspectiveError:
+        pass
+    finally:
+        await client.close()
+    assert mock.stats['requests'] - before == 1, mock.stats['requests'] - before
+
+
+async def check_retry_after_capped(mock):
+    client = client_for(mock, timeout=0.5)
+    mock.retry_after = 3600
+    mock.fail_next(429)
+    start = time.perf_counter()
+    try:
+        await client.score('hello there')
+    finally:
+        mock.retry_after = None
+        await client.close()
+    elapsed = time.perf_counter() - start
+    assert elapsed < 1.5, elapsed
+
+
+async def check_timeout_retried(mock):
+    client = client_for(mock, timeout=0.3)
+    mock.fail_next(1.0)
+    start = time.perf_counter()
+    scores, requests = await requests_during(mock, client.score('hello there'))
+    await client.close()
+    assert 'TOXICITY' in scores and requests == 2 and time.perf_counter() - start >= 0.3, requests
+
+
+async def check_backoff_releases_slot(mock):
+    # With one slot, a call backing off must not keep a second call waiting
+    client = client_for(mock, max_concurrency=1, timeout=2)
+    mock.retry_after = 1
+    mock.fail_next(503)
+    finished = {}
+
+    async def timed(name, text):
+        await client.score(text)
+        finished[name] = time.perf_counter()
+
+    try:
+        first = asyncio.create_task(timed('retried', 'first message'))
+        await asyncio.sleep(0.1)
+        await timed('other', 'second message')
+        await first
+    finally:
+        mock.retry_after = None
+        await client.close()
+    assert finished['other'] < finished['retried'] - 0.5, finished
+
+
+CHECKS = (check_retries_until_success, check_gives_up, check_no_retry_on_client_error, check_retry_after_capped,
+          check_timeout_retried, check_backoff_releases_slot)
+
+
+async def main():
+    mock = MockPerspective(latency=0.01, seed=152)
+    await mock.start()
+    failed = 0
+    try:
+        for check in CHECKS:
+            try:
+                await check(mock)
+                print(f'ok      {check.__name__}')
+            except AssertionError as e:
+                failed += 1
+                print(f'FAILED  {check.__name__}: {e}')
+    finally:
+        await mock.stop()
+    if failed:
+        raise SystemExit(f'{failed} of {len(CHECKS)} checks failed')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
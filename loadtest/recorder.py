@@ -0,0 +1,74 @@
+import asyncio
+import gzip
+import json
+import time
+from .fakes import FakeAttachment, FakeGuild, FakeMessage, FakeUser
+
+
+class TrafficRecorder:
+    '''
+    Captures guild messages the bot sees as gzipped JSON lines with short keys, one line per message.
+    Times are seconds since recording started.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._start = time.monotonic()
+
+    def record(self, message):
+        if not message.guild:
+            return
+        record = {
+            't': round(time.monotonic() - self._start, 3),
+            'g': [message.guild.id, message.guild.name],
+            'c': [message.channel.id, message.channel.name],
+            'a': [message.author.id, message.author.name],
+            'm': message.content,
+        }
+        if message.attachments:
+            record['f'] = [[a.url, a.filename, a.content_type, a.size, a.width, a.height] for a in message.attachments]
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class TrafficReplayer:
+    '''
+    Rebuilds recorded traffic as fake Discord objects and plays it back `speed` times faster than it
+    was recorded. Guilds, channels and users are created once per id so the bot sees consistent objects.
+    '''
+
+    def __init__(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.records = [json.loads(line) for line in f if line.strip()]
+        self.guilds = {}
+        self.channels = {}
+        self.users = {}
+        for record in self.records:
+            guild_id, guild_name = record['g']
+            if guild_id not in self.guilds:
+                self.guilds[guild_id] = FakeGuild(guild_name, id=guild_id)
+            channel_id, channel_name = record['c']
+            if channel_id not in self.channels:
+                self.channels[channel_id] = self.guilds[guild_id].add_channel(channel_name, id=channel_id)
+            author_id, author_name = record['a']
+            if author_id not in self.users:
+                self.users[author_id] = FakeUser(author_name, id=author_id)
+
+    def __len__(self):
+        return len(self.records)
+
+    def build_message(self, record):
+        attachments = [FakeAttachment(url, filename, content_type, size, width, height)
+                       for url, filename, content_type, size, width, height in record.get('f', [])]
+        return FakeMessage(record['m'], self.users[record['a'][0]], self.channels[record['c'][0]], attachments)
+
+    async def replay(self, deliver, speed=1.0):
+        start = time.monotonic()
+        for record in self.records:
+            delay = record['t'] / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await deliver(self.build_message(record))
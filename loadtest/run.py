@@ -0,0 +1,183 @@
+'''
+Drives ModBot.on_message with synthetic or replayed traffic against a local mock Perspective server and
+reports throughput, end-to-end latency and event-loop lag.
+
+    python -m loadtest.run --messages 5000 --rate 200 --latency 0.05 --error-rate 0.01
+    python -m loadtest.run --replay traffic.jsonl.gz --speed 20
+'''
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import bot as botmodule
+from channel_index import ChannelIndex
+from .fakes import FakeGuild, FakeMessage, FakeUser
+from .mock_perspective import MockPerspective, TOXIC_WORDS
+from .recorder import TrafficReplayer
+
+BENIGN_WORDS = ['hello', 'everyone', 'what', 'is', 'the', 'homework', 'for', 'today', 'lol', 'nice', 'game',
+                'thanks', 'see', 'you', 'later', 'anyone', 'want', 'to', 'play', 'tonight', 'good', 'morning']
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+class LoadTestBot(botmodule.ModBot):
+    '''
+    ModBot that records how long each channel message took from delivery to the end of moderation.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.message_latencies = []
+
+    async def handle_channel_message(self, message, before=None, *args):
+        try:
+            await super().handle_channel_message(message, before, *args)
+        finally:
+            self.message_latencies.append(time.perf_counter() - message.received_at)
+
+
+async def monitor_loop_lag(samples, interval=0.05):
+    '''
+    Measures how late the event loop wakes up compared to when it was asked to.
+    '''
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+def synthetic_messages(count, users, toxic_fraction, duplicate_fraction, seed):
+    rng = random.Random(seed)
+    toxic_words = sorted(TOXIC_WORDS)
+    sent = []
+    for _ in range(count):
+        if sent and rng.random() < duplicate_fraction:
+            content = rng.choice(sent)
+        else:
+            words = rng.choices(BENIGN_WORDS, k=rng.randint(3, 12))
+            if rng.random() < toxic_fraction:
+                words += rng.choices(toxic_words, k=rng.randint(1, 3))
+                rng.shuffle(words)
+            content = ' '.join(words)
+            sent.append(content)
+        yield content, rng.choice(users)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000, help='synthetic messages to send')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second to offer (0 = as fast as possible)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--toxic-fraction', type=float, default=0.05)
+    parser.add_argument('--duplicate-fraction', type=float, default=0.2)
+    parser.add_argument('--replay', help='replay a file recorded with TRAFFIC_RECORD_PATH instead')
+    parser.add_argument('--speed', type=float, default=10.0, help='replay speed-up factor')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean mock Perspective latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock Perspective requests that fail')
+    parser.add_argument('--workers', type=int, default=botmodule.MESSAGE_WORKERS)
+    parser.add_argument('--group', default='1', help='group number the bot moderates for')
+    parser.add_argument('--seed', type=int, default=152)
+    args = parser.parse_args()
+
+    mock = MockPerspective(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    await mock.start()
+
+    # The on-disk score cache and warning counts would carry over between runs
+    state_dir = tempfile.TemporaryDirectory()
+    botmodule.SCORE_CACHE_PATH = None
+    botmodule.STATE_STORE_PATH = os.path.join(state_dir.name, 'state.db')
+    botmodule.AUDIT_DIR = os.path.join(state_dir.name, 'audit')
+    botmodule.MESSAGE_WORKERS = args.workers
+    bot = LoadTestBot('loadtest')
+    bot.perspective.url = mock.url
+    bot.group_num = args.group
+    bot.channel_index = ChannelIndex(args.group)
+    bot_user = FakeUser(f'Group {args.group} Bot')
+    bot._connection.user = bot_user
+
+    def register_guild(guild):
+        guild.add_channel(f'group-{args.group}-mod')
+        for channel in guild.text_channels:
+            channel.bot_user = bot_user
+        bot.channel_index.add_guild(guild)
+
+    replayer = None
+    if args.replay:
+        replayer = TrafficReplayer(args.replay)
+        for guild in replayer.guilds.values():
+            register_guild(guild)
+        total = len(replayer)
+    else:
+        guild = FakeGuild('Load Test Guild')
+        channel = guild.add_channel(f'group-{args.group}')
+        register_guild(guild)
+        users = [FakeUser(f'user{i}') for i in range(args.users)]
+        total = args.messages
+
+    # The image models aren't loaded here, so rather than leaving attachments waiting for a warm-up that never
+    # runs, messages with attachments are moderated on their text and their images counted as skipped
+    bot.images_ready.set()
+    attachment_messages = 0
+
+    async def deliver(message):
+        nonlocal attachment_messages
+        if message.attachments:
+            attachment_messages += 1
+        await bot.on_message(message)
+
+    lag = []
+    lag_monitor = asyncio.create_task(monitor_loop_lag(lag))
+    bot.scheduler.start()
+
+    start = time.perf_counter()
+    if replayer:
+        await replayer.replay(deliver, speed=args.speed)
+    else:
+        interval = 1 / args.rate if args.rate else 0
+        for i, (content, user) in enumerate(synthetic_messages(args.messages, users, args.toxic_fraction,
+                                                               args.duplicate_fraction, args.seed)):
+            if interval:
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await deliver(FakeMessage(content, user, channel))
+    await bot.scheduler.join()
+    elapsed = time.perf_counter() - start
+    await bot.dispatcher.drain()
+
+    lag_monitor.cancel()
+    bot.scheduler.stop()
+    await bot.perspective.close()
+    await bot.store.close()
+    await bot.score_cache.close()
+    bot.audit.close()
+    await mock.stop()
+    state_dir.cleanup()
+
+    latencies = [latency * 1000 for latency in bot.message_latencies]
+    lag_ms = [sample * 1000 for sample in lag]
+    print(f'{total} messages in {elapsed:.2f}s: {total / elapsed:.1f} messages/s with {args.workers} workers')
+    print(f'end-to-end latency ms: p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  '
+          f'p99 {percentile(latencies, 99):.1f}  max {max(latencies, default=0):.1f}')
+    print(f'event loop lag ms:     p50 {percentile(lag_ms, 50):.1f}  p99 {percentile(lag_ms, 99):.1f}  '
+          f'max {max(lag_ms, default=0):.1f}')
+    print(f'perspective requests {mock.stats["requests"]} (errors injected {mock.stats["errors"]}), '
+          f'score cache {bot.score_cache.stats}')
+    print(f'scheduler: {bot.scheduler.stats}')
+    if attachment_messages:
+        print(f'{attachment_messages} messages with attachments were moderated on their text only; '
+              f'the image models are not loaded in the load test')
+    print(f'dispatcher: {bot.dispatcher.stats["posted"]} alerts and notices sent as {bot.dispatcher.stats["sent"]} Discord messages')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
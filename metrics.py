@@ -0,0 +1,176 @@
+import asyncio
+import bisect
+import time
+from aiohttp import web
+
+# Seconds; spans from a cache hit (microseconds) up to a slow model or Perspective call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PREFIX = 'modbot_'
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Span:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def _label_key(labels):
+    # Label values are kept as strings, so one label can be given as 429 in one place and 'TimeoutError' in
+    # another and the keys still sort
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    '''
+    Counters, histograms and callback gauges exposed in Prometheus text format. Everything is a no-op until
+    `enable()` is called, so the instrumentation can stay in the hot path without costing anything.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self._counters = {} # Map from (name, labels) to value
+        self._histograms = {} # Map from (name, labels) to _Histogram
+        self._gauges = {} # Map from name to (function returning {labels: value} or a number, help)
+        self._help = {}
+        self._runner = None
+        self._lag_task = None
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = _Histogram(DEFAULT_BUCKETS)
+        histogram.observe(value)
+
+    def span(self, name, **labels):
+        '''
+        Times the enclosed block into histogram `name`, e.g. `with metrics.span('perspective_seconds'):`.
+        '''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, labels)
+
+    def gauge(self, name, fn, help=''):
+        '''
+        Registers a value read at scrape time. `fn` returns a number, or a dict mapping label tuples to numbers.
+        '''
+        self._gauges[name] = fn
+        if help:
+            self._help[name] = help
+
+    def render(self):
+        lines = []
+        for name in sorted({name for name, _ in self._counters}):
+            lines.append(f'# TYPE {PREFIX}{name} counter')
+            for (counter_name, labels), value in sorted(self._counters.items()):
+                if counter_name == name:
+                    lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+
+        for name in sorted({name for name, _ in self._histograms}):
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for (histogram_name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}')
+
+        for name, fn in sorted(self._gauges.items()):
+            if name in self._help:
+                lines.append(f'# HELP {PREFIX}{name} {self._help[name]}')
+            lines.append(f'# TYPE {PREFIX}{name} gauge')
+            value = fn()
+            if isinstance(value, dict):
+                for labels, labelled_value in sorted(value.items()):
+                    lines.append(f'{PREFIX}{name}{_format_labels(labels)} {labelled_value}')
+            else:
+                lines.append(f'{PREFIX}{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    async def _monitor_loop_lag(self, interval):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.observe('event_loop_lag_seconds', time.perf_counter() - start - interval)
+
+    async def serve(self, host='127.0.0.1', port=9152, lag_interval=0.5):
+        '''
+        Enables collection and starts the /metrics endpoint and the event-loop lag monitor.
+        '''
+        if self._runner is not None:
+            return
+        self.enable()
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._lag_task = asyncio.ensure_future(self._monitor_loop_lag(lag_interval))
+
+    async def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Shared by every module so all instrumentation lands on the one endpoint
+metrics = Metrics()
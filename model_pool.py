@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from backends import create_backend, DEFAULT_BACKEND
+from metrics import metrics
+
+# The inference backend loaded into the current process
+_backend = None
+# Shared by a pool's workers so each of its start-up no-ops runs in a different worker
+_barrier = None
+
+
+def load_models(backend=DEFAULT_BACKEND, threads=None):
+    '''
+    Loads the models of the given backend into this process once and runs a blank image through each of
+    them, so the first real image doesn't pay for graph construction.
+    '''
+    global _backend
+    if _backend is None:
+        _backend = create_backend(backend, threads)
+        _backend.warm_up()
+
+
+def get_backend():
+    if _backend is None:
+        load_models()
+    return _backend
+
+
+def _init_worker(backend, threads, barrier):
+    global _barrier
+    _barrier = barrier
+    load_models(backend, threads)
+
+
+def _ready():
+    # A worker only takes a job once it has loaded its models, and the first one to do so would otherwise run
+    # every no-op itself; waiting here until each worker holds one means they all return once all are loaded
+    _barrier.wait()
+    return True
+
+
+class ModelPool:
+    '''
+    A pool of worker processes that each keep the image models resident. Inference runs in the workers
+    so inference never blocks the asyncio loop. `threads` is how many threads each worker's backend may
+    use; by default the cores are split between the workers.
+    '''
+
+    def __init__(self, workers=2, backend=DEFAULT_BACKEND, threads=None):
+        self.workers = workers
+        self.backend = backend
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self._executor = None
+        self._loads = []
+
+    def start(self):
+        if self._executor is not None:
+            return
+        # spawn rather than fork: the bot process has an event loop and threads running that must not be copied
+        context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                             initargs=(self.backend, self.threads, context.Barrier(self.workers)))
+        # One no-op per worker makes every process start up and load its models now instead of on the first image
+        self._loads = [self._executor.submit(_ready) for _ in range(self.workers)]
+        for future in self._loads:
+            future.add_done_callback(lambda future: metrics.inc('model_loads_total'))
+
+    async def wait_ready(self):
+        '''
+        Starts the pool if needed and waits until every worker has loaded its models.
+        '''
+        self.start()
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in self._loads))
+
+    async def run(self, fn, *args):
+        '''
+        Runs `fn(*args)` in a worker. If a worker has died (out of memory, a crash in the model library) the
+        whole pool is broken, so it is replaced with a fresh one and the call is retried once.
+        '''
+        self.start()
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, partial(fn, *args))
+        except BrokenProcessPool:
+            # Every call in flight fails together; only the first to notice replaces the pool
+            if self._executor is executor:
+                print('Cannot use the model pool because a worker died, restarting it')
+                metrics.inc('model_pool_restarts_total')
+                self.shutdown()
+                self.start()
+            return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._loads = []
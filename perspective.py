@@ -0,0 +1,94 @@
+import asyncio
+import json
+import random
+import aiohttp
+from metrics import metrics
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+ATTRIBUTES = ('SEVERE_TOXICITY', 'PROFANITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION')
+
+# Perspective answers these when it is overloaded or we are over quota, so they are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PerspectiveError(Exception):
+    pass
+
+
+class PerspectiveClient:
+    '''
+    Async client for the Perspective API. A single keep-alive session is shared by every call,
+    at most `max_concurrency` requests are in flight at once and 429/5xx responses are retried
+    with exponential backoff. A call waiting to retry doesn't hold up the others, and never waits
+    longer than `timeout`, whatever Retry-After asks for. Point `url` at a local server to run the
+    bot without the real API; loadtest/perspective_check.py does that to exercise these paths.
+    '''
+
+    def __init__(self, key, url=PERSPECTIVE_URL, timeout=10, max_concurrency=8, max_retries=3, backoff=0.5):
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _retry_delay(self, attempt, response=None):
+        # Honour Retry-After when Perspective sends one, otherwise back off exponentially with jitter
+        delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                delay = float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        return min(max(delay, 0), self.timeout)
+
+    async def score(self, text, attributes=ATTRIBUTES):
+        '''
+        Given some text, returns a dictionary mapping each requested attribute to its summary score.
+        '''
+        data_dict = {
+            'comment': {'text': text},
+            'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in attributes},
+            'doNotStore': True
+        }
+        session = self._get_session()
+        params = {'key': self.key} if self.key else None
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            # Only the request itself holds a slot; backing off outside it lets other calls go ahead
+            async with self._semaphore:
+                try:
+                    async with session.post(self.url, params=params, data=json.dumps(data_dict)) as response:
+                        if response.status == 200:
+                            response_dict = await response.json(content_type=None)
+                            break
+                        metrics.inc('perspective_errors_total', status=response.status)
+                        if response.status not in RETRY_STATUSES or last_attempt:
+                            raise PerspectiveError(f'Perspective returned HTTP {response.status}: {await response.text()}')
+                        delay = self._retry_delay(attempt, response)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    metrics.inc('perspective_errors_total', status=type(e).__name__)
+                    if last_attempt:
+                        raise PerspectiveError(f'Perspective request failed: {e!r}') from e
+                    delay = self._retry_delay(attempt)
+            await asyncio.sleep(delay)
+
+        scores = {}
+        for attr in response_dict["attributeScores"]:
+            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+        return scores
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,141 @@
+import os
+import struct
+import cv2
+import numpy as np
+
+FLAGGED = 1
+CLEARED = 0
+
+# Two images count as the same picture if both their pHashes and dHashes are within this many bits
+MATCH_DISTANCE = 6
+
+_RECORD = struct.Struct('<QQB')
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def phash(gray):
+    '''
+    64-bit perceptual hash: the sign of the low-frequency DCT coefficients against their median.
+    '''
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _bits_to_int(low > np.median(low.flatten()[1:]))
+
+
+def dhash(gray):
+    '''
+    64-bit difference hash: whether each pixel is brighter than its right-hand neighbour.
+    '''
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def array_hashes(image):
+    '''
+    Hashes an image that is already decoded into a BGR array, so the bytes don't have to be decoded again.
+    '''
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return phash(gray), dhash(gray)
+
+
+def _flip_masks(bits, max_flips):
+    '''
+    Every `bits`-wide mask with at most `max_flips` bits set, smallest first.
+    '''
+    masks = [0]
+    if max_flips >= 1:
+        masks += [1 << i for i in range(bits)]
+    if max_flips >= 2:
+        masks += [(1 << i) | (1 << j) for i in range(bits) for j in range(i + 1, bits)]
+    return tuple(masks)
+
+
+class HashIndex:
+    '''
+    Multi-index hash over 64-bit pHashes. Each hash is split into three 22-bit chunks with a table per chunk;
+    by the pigeonhole principle any hash within `radius` bits agrees with the query to within radius // 3 bits
+    on at least one chunk, so a lookup probes a few hundred mostly-empty buckets no matter how big the index is.
+
+    Entries are appended to `path` as they're added so decisions survive restarts; later entries for the
+    same image override earlier ones.
+    '''
+
+    CHUNKS = 3
+    CHUNK_BITS = 22
+
+    def __init__(self, path=None, radius=MATCH_DISTANCE):
+        self.path = path
+        self.radius = radius
+        self._phashes = []
+        self._dhashes = []
+        self._labels = []
+        self._exact = {} # Map from (phash, dhash) to entry id
+        self._tables = [{} for _ in range(self.CHUNKS)]
+        self._masks = _flip_masks(self.CHUNK_BITS, radius // self.CHUNKS)
+        if path and os.path.isfile(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._exact)
+
+    def _chunks(self, value):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+
+    def _insert(self, ph, dh, label):
+        key = (ph, dh)
+        if key in self._exact:
+            self._labels[self._exact[key]] = label
+            return
+        entry = len(self._phashes)
+        self._phashes.append(ph)
+        self._dhashes.append(dh)
+        self._labels.append(label)
+        self._exact[key] = entry
+        for table, chunk in zip(self._tables, self._chunks(ph)):
+            table.setdefault(chunk, []).append(entry)
+
+    def add(self, hashes, label):
+        ph, dh = hashes
+        self._insert(ph, dh, label)
+        if self.path:
+            with open(self.path, 'ab') as f:
+                f.write(_RECORD.pack(ph, dh, label))
+
+    def lookup(self, hashes):
+        '''
+        Returns the label of the closest known image within `radius` bits, or None if there isn't one.
+        '''
+        ph, dh = hashes
+        entry = self._exact.get((ph, dh))
+        if entry is not None:
+            return self._labels[entry]
+
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(ph)):
+            for mask in self._masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+
+        best = None
+        best_distance = self.radius + 1
+        for entry in candidates:
+            distance = (self._phashes[entry] ^ ph).bit_count()
+            if distance < best_distance and (self._dhashes[entry] ^ dh).bit_count() <= self.radius:
+                best, best_distance = entry, distance
+        return None if best is None else self._labels[best]
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # A crash mid-append can leave a partial record at the end; ignore it
+        usable = len(data) - len(data) % _RECORD.size
+        for ph, dh, label in _RECORD.iter_unpack(data[:usable]):
+            self._insert(ph, dh, label)
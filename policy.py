@@ -0,0 +1,112 @@
+import json
+import os
+import time
+import numpy as np
+from perspective import ATTRIBUTES
+from report import ToxicThreshold, QuestionableThreshold
+
+
+class GuildPolicy:
+    '''
+    One guild's thresholds compiled into dense vectors, one column per Perspective attribute in ATTRIBUTES order.
+    '''
+
+    def __init__(self, toxic, questionable):
+        self.toxic = np.array([toxic[attr] for attr in ATTRIBUTES], dtype=np.float64)
+        self.questionable = np.array([questionable[attr] for attr in ATTRIBUTES], dtype=np.float64)
+
+
+def scores_matrix(scores_list):
+    '''
+    Packs a list of score dicts into an (n, len(ATTRIBUTES)) array; attributes a dict doesn't have are 0.
+    '''
+    matrix = np.zeros((len(scores_list), len(ATTRIBUTES)), dtype=np.float64)
+    for row, scores in enumerate(scores_list):
+        for column, attr in enumerate(ATTRIBUTES):
+            matrix[row, column] = scores.get(attr, 0)
+    return matrix
+
+
+class PolicyEngine:
+    '''
+    Per-guild moderation thresholds. The config file looks like
+
+        {"default": {"toxic": {"THREAT": 0.85}, "questionable": {...}},
+         "guilds": {"<guild id>": {"toxic": {...}, "questionable": {...}}}}
+
+    where every level is optional: guild values override the defaults, which override the ToxicThreshold
+    and QuestionableThreshold enums. The file is re-read when it changes, checked at most every
+    `reload_interval` seconds, so policy changes apply without a restart.
+    '''
+
+    def __init__(self, path=None, reload_interval=5):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked = 0
+        self._compile({})
+
+    def _compile(self, config):
+        base_toxic = {member.name: member.value for member in ToxicThreshold}
+        base_questionable = {member.name: member.value for member in QuestionableThreshold}
+        default = config.get('default', {})
+        base_toxic.update(default.get('toxic', {}))
+        base_questionable.update(default.get('questionable', {}))
+
+        default = GuildPolicy(base_toxic, base_questionable)
+        guilds = {}
+        for guild_id, guild_config in config.get('guilds', {}).items():
+            toxic = dict(base_toxic, **guild_config.get('toxic', {}))
+            questionable = dict(base_questionable, **guild_config.get('questionable', {}))
+            guilds[int(guild_id)] = GuildPolicy(toxic, questionable)
+        # Only swapped in once every guild has compiled, so a bad entry leaves the previous policy whole
+        self.default, self.guilds = default, guilds
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if not self.path or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                config = json.load(f)
+            self._compile(config)
+        except (ValueError, KeyError, TypeError) as e:
+            # Keep enforcing the last good policy rather than none at all
+            print(f'Cannot load {self.path} because ', e)
+        self._mtime = mtime
+
+    def policy(self, guild_id):
+        self._maybe_reload()
+        return self.guilds.get(guild_id, self.default)
+
+    def evaluate_batch(self, guild_id, scores_list):
+        '''
+        Evaluates many score dicts against a guild's policy at once. Returns (levels, toxic, questionable):
+        levels[i] is 1 if message i crossed a toxic threshold, 2 if only questionable ones and 0 otherwise,
+        and the two boolean matrices say which attributes crossed which threshold.
+        '''
+        policy = self.policy(guild_id)
+        matrix = scores_matrix(scores_list)
+        toxic = matrix > policy.toxic
+        questionable = (matrix > policy.questionable) & ~toxic
+        levels = np.where(toxic.any(axis=1), 1, np.where(questionable.any(axis=1), 2, 0))
+        return levels, toxic, questionable
+
+    def evaluate(self, guild_id, scores):
+        '''
+        Single-message form in the shape Report.eval_threshold returns: (level, list of threshold enums).
+        '''
+        levels, toxic, questionable = self.evaluate_batch(guild_id, [scores])
+        level = int(levels[0])
+        if level == 1:
+            return 1, [ToxicThreshold[ATTRIBUTES[i]] for i in np.flatnonzero(toxic[0])]
+        if level == 2:
+            return 2, [QuestionableThreshold[ATTRIBUTES[i]] for i in np.flatnonzero(questionable[0])]
+        return 0, []
@@ -0,0 +1,233 @@
+'''
+In-process first pass over message text, so clearly benign messages don't need a Perspective call.
+
+Two signals are combined: an Aho-Corasick matcher over a curated lexicon (run on text with leetspeak,
+punctuation tricks and repeated letters normalized away), and a small logistic-regression model over
+hashed word and character n-grams that is trained offline:
+
+    python prescreen.py train corpus.jsonl --out prescreen_model.json
+
+Each corpus line is {"text": ..., "scores": {<Perspective attribute>: <score>, ...}}, i.e. messages
+together with what Perspective said about them. A message is treated as a positive if any score is over
+its questionable threshold in report.py.
+'''
+import argparse
+import json
+import math
+import os
+import random
+import re
+import zlib
+
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prescreen_lexicon.txt')
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prescreen_model.json')
+
+FEATURE_BITS = 18
+
+# Messages the model puts below this probability, with no lexicon hits, skip Perspective
+BENIGN_THRESHOLD = 0.05
+
+LEET = str.maketrans({'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', '9': 'g',
+                      '@': 'a', '$': 's', '|': 'i', '+': 't', '€': 'e'})
+
+
+def normalize(text):
+    '''
+    Lowercases and undoes common obfuscation: leetspeak digits and symbols, punctuation inside words
+    ("f.u.c.k"), spaced-out letters ("k y s") and stretched letters ("stuuupid"). Words stay separated
+    by single spaces.
+    '''
+    text = text.casefold().translate(LEET)
+    text = re.sub(r'[^a-z\s]', '', text)
+    text = ' '.join(text.split())
+    text = re.sub(r'\b(?:[a-z] ){2,}[a-z]\b', lambda m: m.group(0).replace(' ', ''), text)
+    return re.sub(r'(.)\1+', r'\1', text)
+
+
+class AhoCorasick:
+    '''
+    Matches every pattern against a text in one pass. Patterns are matched on whole words only, so
+    "ass" doesn't match inside "class".
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(index)
+
+        # Breadth-first so every state's failure link is known before its children need it
+        queue = list(self._goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                if self._fail[child] == child:
+                    self._fail[child] = 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text):
+        '''
+        Yields the index of every pattern that occurs in `text` as a whole word or phrase.
+        '''
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for index in self._output[state]:
+                start = end - len(self.patterns[index]) + 1
+                if (start == 0 or text[start - 1] == ' ') and (end + 1 == len(text) or text[end + 1] == ' '):
+                    yield index
+
+
+def load_lexicon(path=LEXICON_PATH):
+    '''
+    Reads `term<TAB>weight` lines; blank lines and lines starting with # are ignored.
+    '''
+    terms = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            term, _, weight = line.partition('\t')
+            terms[normalize(term)] = float(weight or 1)
+    return terms
+
+
+def features(normalized):
+    '''
+    Hashed word unigrams and bigrams plus character trigrams, as bucket indices.
+    '''
+    words = normalized.split()
+    grams = words + [a + ' ' + b for a, b in zip(words, words[1:])]
+    padded = f' {normalized} '
+    grams += ['#' + padded[i:i + 3] for i in range(len(padded) - 2)]
+    mask = (1 << FEATURE_BITS) - 1
+    return [zlib.crc32(gram.encode('utf-8')) & mask for gram in grams]
+
+
+def _sigmoid(x):
+    return 1 / (1 + math.exp(-max(-30, min(30, x))))
+
+
+class LinearModel:
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = weights or {} # Map from feature bucket to weight; most buckets are zero
+        self.bias = bias
+
+    def predict(self, feature_list):
+        return _sigmoid(self.bias + sum(self.weights.get(f, 0.0) for f in feature_list))
+
+    def train(self, examples, epochs=5, learning_rate=0.1, l2=1e-6, seed=152):
+        '''
+        Plain SGD on log loss. `examples` is a list of (features, label) pairs.
+        '''
+        rng = random.Random(seed)
+        examples = list(examples)
+        for _ in range(epochs):
+            rng.shuffle(examples)
+            for feature_list, label in examples:
+                gradient = self.predict(feature_list) - label
+                self.bias -= learning_rate * gradient
+                for f in feature_list:
+                    weight = self.weights.get(f, 0.0)
+                    self.weights[f] = weight - learning_rate * (gradient + l2 * weight)
+
+    def save(self, path):
+        weights = {str(f): round(w, 5) for f, w in self.weights.items() if abs(w) > 1e-4}
+        with open(path, 'w') as f:
+            json.dump({'feature_bits': FEATURE_BITS, 'bias': self.bias, 'weights': weights}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data['feature_bits'] != FEATURE_BITS:
+            raise ValueError(f'{path} was trained with {data["feature_bits"]} feature bits, not {FEATURE_BITS}')
+        return cls({int(f): w for f, w in data['weights'].items()}, data['bias'])
+
+
+class PreScreen:
+    '''
+    Decides whether a message needs Perspective. Anything with a lexicon hit, or that the model isn't
+    confident is benign, is escalated. Without a trained model every message is escalated, so the bot
+    behaves exactly as before until one is trained.
+    '''
+
+    def __init__(self, lexicon_path=LEXICON_PATH, model_path=MODEL_PATH, benign_threshold=BENIGN_THRESHOLD):
+        self.lexicon = load_lexicon(lexicon_path) if os.path.isfile(lexicon_path) else {}
+        self._terms = list(self.lexicon)
+        self._matcher = AhoCorasick(self._terms)
+        self.model = LinearModel.load(model_path) if os.path.isfile(model_path) else None
+        self.benign_threshold = benign_threshold
+        self.stats = {'benign': 0, 'escalated': 0}
+
+    def score(self, text):
+        '''
+        Returns (probability the message needs moderation, the lexicon terms it matched).
+        '''
+        normalized = normalize(text)
+        hits = [self._terms[index] for index in set(self._matcher.find(normalized))]
+        if self.model is None:
+            probability = 1.0
+        else:
+            probability = self.model.predict(features(normalized))
+        if hits:
+            probability = max(probability, min(1.0, sum(self.lexicon[term] for term in hits)))
+        return probability, hits
+
+    def is_benign(self, text):
+        probability, hits = self.score(text)
+        benign = not hits and probability < self.benign_threshold
+        self.stats['benign' if benign else 'escalated'] += 1
+        return benign
+
+
+def label_from_scores(scores):
+    from report import QuestionableThreshold
+    return int(any(value > QuestionableThreshold[attr].value for attr, value in scores.items()))
+
+
+def read_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['text'], label_from_scores(record['scores'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train = subparsers.add_parser('train', help='train the hashed-feature model on a labelled corpus')
+    train.add_argument('corpus')
+    train.add_argument('--out', default=MODEL_PATH)
+    train.add_argument('--epochs', type=int, default=5)
+    args = parser.parse_args()
+
+    examples = [(features(normalize(text)), label) for text, label in read_corpus(args.corpus)]
+    model = LinearModel()
+    model.train(examples, epochs=args.epochs)
+    model.save(args.out)
+    positives = sum(label for _, label in examples)
+    print(f'Trained on {len(examples)} messages ({positives} positive), wrote {len(model.weights)} weights to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
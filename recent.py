@@ -0,0 +1,76 @@
+from collections import OrderedDict, deque
+from metrics import metrics
+
+
+class Seen:
+    '''
+    A message the bot saw recently, with what moderation made of it once it has been scored.
+    '''
+    __slots__ = ('message', 'scores', 'verdict')
+
+    def __init__(self, message):
+        self.message = message
+        self.scores = None # [image scores, text scores] as eval_text returned them
+        self.verdict = None # The reasons the bot gave when it flagged the message, '' if it was scored and not flagged
+
+
+class RecentMessages:
+    '''
+    The last `per_channel` messages of each of the `max_channels` most recently active channels, so a report
+    of a recent message is resolved from memory instead of a REST fetch. Each channel is a ring buffer of
+    message ids next to a dict from id to what was seen; channels go least recently active first.
+    '''
+
+    def __init__(self, per_channel=1000, max_channels=500):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self._channels = OrderedDict() # Map from channel id to (deque of message ids, dict of id to Seen)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def add(self, message):
+        channel_id = message.channel.id
+        if channel_id in self._channels:
+            self._channels.move_to_end(channel_id)
+        else:
+            self._channels[channel_id] = (deque(), {})
+            if len(self._channels) > self.max_channels:
+                _, (_, evicted) = self._channels.popitem(last=False)
+                self.stats['evictions'] += len(evicted)
+
+        order, seen = self._channels[channel_id]
+        if message.id in seen:
+            # An edit; keep the verdict until the edit has been moderated too
+            seen[message.id].message = message
+            return
+        order.append(message.id)
+        seen[message.id] = Seen(message)
+        if len(order) > self.per_channel:
+            seen.pop(order.popleft(), None)
+            self.stats['evictions'] += 1
+
+    def record_verdict(self, message, scores, verdict):
+        entry = self._get(message.channel.id, message.id)
+        if entry is not None:
+            entry.scores = scores
+            entry.verdict = verdict
+
+    def _get(self, channel_id, message_id):
+        channel = self._channels.get(channel_id)
+        return channel[1].get(message_id) if channel else None
+
+    def get(self, channel_id, message_id):
+        '''
+        Returns what was seen of a message, or None if it isn't in memory.
+        '''
+        entry = self._get(channel_id, message_id)
+        if entry is not None:
+            self.stats['hits'] += 1
+            metrics.inc('recent_lookups_total', result='hit')
+        else:
+            self.stats['misses'] += 1
+            metrics.inc('recent_lookups_total', result='miss')
+        return entry
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
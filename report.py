@@ -52,9 +52,44 @@ class Report:
     def __init__(self, client):
         self.state = State.REPORT_START
         self.client = client
-        self.message = None
-        self.client.state = self.state
-        self.client.continue_report = None
+        self.message = None # The message being reported
+        self.guild = None # The guild the reported message was sent in
+        self.verdict = None # What the bot made of the reported message when it was posted, if it still knows
+
+    def to_record(self):
+        '''
+        A JSON-friendly snapshot of this report so it can be picked up again after a restart.
+        '''
+        record = {'state': self.state.name}
+        if self.message is not None:
+            record['guild'] = self.guild.id
+            record['channel'] = self.message.channel.id
+            record['message'] = self.message.id
+        return record
+
+    @classmethod
+    async def from_record(cls, client, record):
+        report = cls(client)
+        report.state = State[record['state']]
+        if 'message' in record:
+            report.guild = client.get_guild(record['guild'])
+            channel = report.guild.get_channel(record['channel']) if report.guild else None
+            try:
+                report.message = await report.find_message(channel, record['message'])
+            except (AttributeError, discord.errors.NotFound):
+                # The reported message is gone, so start the report over
+                return cls(client)
+        return report
+
+    async def find_message(self, channel, message_id):
+        '''
+        Looks the message up among the ones the bot saw recently before asking Discord for it.
+        '''
+        seen = self.client.recent.get(channel.id, message_id)
+        if seen is not None:
+            self.verdict = seen.verdict
+            return seen.message
+        return await channel.fetch_message(message_id)
 
     async def handle_message(self, message):
         '''
@@ -64,7 +99,7 @@ class Report:
         '''
 
         if message.content == self.CANCEL_KEYWORD:
-            self.client.state = self.state = State.REPORT_COMPLETE
+            self.state = State.REPORT_COMPLETE
             return ["Report cancelled."]
 
         if self.state == State.REPORT_START:
@@ -72,7 +107,7 @@ class Report:
             reply += "Say `help` at any time for more information.\n\n"
             reply += "Please copy paste the link to the message you want to report.\n"
             reply += "You can obtain this link by right-clicking the message and clicking `Copy Message Link`."
-            self.client.state = self.state = State.AWAITING_MESSAGE
+            self.state = State.AWAITING_MESSAGE
             return [reply]
 
         if self.state == State.AWAITING_MESSAGE:
@@ -81,7 +116,7 @@ class Report:
 
             if not m:
                 return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
-            self.client.private_dm_guild = guild = self.client.get_guild(int(m.group(1)))
+            self.guild = guild = self.client.get_guild(int(m.group(1)))
             if not guild:
                 return [
                     "I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
@@ -90,14 +125,14 @@ class Report:
                 return [
                     "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                message = await channel.fetch_message(int(m.group(3)))
-                self.client.message = message
+                message = await self.find_message(channel, int(m.group(3)))
+                self.message = message
             except discord.errors.NotFound:
                 return [
                     "It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
 
             # Here we've found the message - it's up to you to decide what to do next!
-            self.client.state = self.state = State.MESSAGE_IDENTIFIED
+            self.state = State.MESSAGE_IDENTIFIED
             reply = "I found this message:\n" + "```" + message.author.name + ": " + message.content + "```\n"
             reply += "Please choose why you wish to report this content\n\n"
             reply += "`" + "spam" + "`" + "\n"
@@ -114,10 +149,9 @@ class Report:
 
             return [reply]
 
-        if self.client.state == State.CONTINUE_REPORT:
+        if self.state == State.CONTINUE_REPORT:
             try:
                 result = Type[message.content.upper()]
-                self.state = self.client.state
                 return result
             except KeyError:
                 return "Invalid response"
@@ -132,28 +166,14 @@ class Report:
         except KeyError:
             "Invalid response"
 
-    def eval_threshold(self, scores):
+    def eval_threshold(self, scores, guild_id=None):
         '''
-        Check the threshold of of every message
+        Check the threshold of of every message against the policy of the guild it was sent in
         '''
-
-        toxic_results = []
-        questionable_results = []
-        for key in scores.keys():
-            if scores.get(key, 0) > ToxicThreshold[key].value:
-                toxic_results.append(ToxicThreshold[key])
-            elif scores.get(key, 0) > QuestionableThreshold[key].value:
-                questionable_results.append(QuestionableThreshold[key])
-
-        if toxic_results:
-            return 1, toxic_results
-        elif questionable_results:
-            return 2, questionable_results
-        else:
-            return 0, []
+        return self.client.policy.evaluate(guild_id, scores)
 
     def perform_toxic_action(self, toxic_results, author_id):
-        self.client.warning_count[author_id] += 1
+        self.client.store.increment_warning(author_id)
 
         threshold_phrase = {
             ToxicThreshold.IDENTITY_ATTACK: 'attacking identity',
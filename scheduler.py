@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+from metrics import metrics
+
+# Priority classes, most urgent first
+DM, IMAGE, TEXT = 0, 1, 2
+CLASS_NAMES = ('dm', 'image', 'text')
+
+
+class Job:
+    __slots__ = ('fn', 'args', 'enqueued')
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.enqueued = time.monotonic()
+
+
+class Scheduler:
+    '''
+    Runs moderation work on a fixed set of workers, always taking the most urgent class first: DM reports,
+    then messages with attachments, then plain text. Each class has a bounded queue. For a class with a
+    deadline, a full queue drops its oldest job and a job that waited longer than the deadline is dropped
+    rather than run late, so a raid costs coverage instead of an ever-growing backlog. A class without a
+    deadline is never dropped; submitting to it waits for room instead.
+
+    `degraded` is true while the text backlog is over `degrade_at` of its queue, so scoring can fall back
+    to something cheaper until the workers catch up.
+    '''
+
+    def __init__(self, workers=16, max_sizes=(100, 500, 1000), deadlines=(None, 300, 60), degrade_at=0.5):
+        self.workers = workers
+        self.max_sizes = max_sizes
+        self.deadlines = deadlines
+        self.degrade_at = degrade_at
+        self._queues = [deque() for _ in CLASS_NAMES]
+        self._space = [asyncio.Event() for _ in CLASS_NAMES]
+        self._items = asyncio.Semaphore(0)
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+        self.stats = {'submitted': 0, 'completed': 0, 'shed_full': 0, 'shed_deadline': 0}
+
+    @property
+    def degraded(self):
+        return len(self._queues[TEXT]) >= self.degrade_at * self.max_sizes[TEXT]
+
+    def depth(self, priority):
+        return len(self._queues[priority])
+
+    def _shed(self, priority, reason):
+        self.stats['shed_' + reason] += 1
+        metrics.inc('scheduler_shed_total', **{'class': CLASS_NAMES[priority], 'reason': reason})
+        self._job_done()
+
+    def _job_done(self):
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._idle.set()
+
+    async def submit(self, priority, fn, *args):
+        '''
+        Queues `fn(*args)` in the given priority class.
+        '''
+        queue = self._queues[priority]
+        replaced = False
+        if len(queue) >= self.max_sizes[priority]:
+            if self.deadlines[priority] is None:
+                while len(queue) >= self.max_sizes[priority]:
+                    self._space[priority].clear()
+                    await self._space[priority].wait()
+            else:
+                queue.popleft()
+                self._shed(priority, 'full')
+                replaced = True
+
+        queue.append(Job(fn, args))
+        self._unfinished += 1
+        self._idle.clear()
+        self.stats['submitted'] += 1
+        # A job that replaced a dropped one takes over its slot, so there is no new job for the workers to count
+        if not replaced:
+            self._items.release()
+
+    def _next_job(self):
+        for priority, queue in enumerate(self._queues):
+            if queue:
+                job = queue.popleft()
+                self._space[priority].set()
+                return priority, job
+
+    async def _worker(self):
+        while True:
+            await self._items.acquire()
+            priority, job = self._next_job()
+            deadline = self.deadlines[priority]
+            if deadline is not None and time.monotonic() - job.enqueued > deadline:
+                self._shed(priority, 'deadline')
+                continue
+            try:
+                with metrics.span('message_seconds', **{'class': CLASS_NAMES[priority]}):
+                    await job.fn(*job.args)
+            except Exception as e:
+                print('Cannot moderate message because ', repr(e))
+            finally:
+                self.stats['completed'] += 1
+                self._job_done()
+
+    def start(self):
+        # on_ready runs again after a reconnect, so only start the workers once
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def join(self):
+        '''
+        Waits until every job submitted so far has run or been dropped.
+        '''
+        await self._idle.wait()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_text(text):
+    '''
+    Normalizes a message so that edits which only change whitespace or unicode form map to the same key.
+    '''
+    text = unicodedata.normalize('NFC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def cache_key(text, attributes):
+    data = normalize_text(text) + '\0' + ','.join(sorted(attributes))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ScoreCache:
+    '''
+    Content-addressed cache for Perspective scores. Entries live in a bounded in-memory LRU with a TTL,
+    and optionally in a SQLite file so they survive restarts. The file runs in WAL mode, so several bot
+    processes can share it: readers don't block on a process that is writing. New scores are written in
+    batches on a dedicated writer thread, like StateStore's. Once `start` has been called, expired rows
+    are pruned from the file on that thread every `prune_interval` seconds, whether or not anything new
+    is being written.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=24 * 60 * 60, db_path=None, flush_interval=0.5, prune_interval=60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+        self._entries = OrderedDict() # Map from key to (time stored, scores)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_hits': 0}
+        self._db = None
+        self._writer = None
+        self._pending = {} # Map from key to (time stored, scores as JSON) not yet written
+        self._flush_task = None
+        self._prune_task = None
+        if db_path:
+            self._db = self._connect()
+            self._db.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, stored REAL, scores TEXT)')
+            self._db.commit()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='score-cache')
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self):
+        '''
+        Starts pruning the file in the background. Safe to call again; it only ever starts once.
+        '''
+        if self._db is not None and self._prune_task is None:
+            self._prune_task = asyncio.ensure_future(self._prune_periodically())
+
+    async def _prune_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.prune_interval)
+            try:
+                await loop.run_in_executor(self._executor, self._prune)
+            except sqlite3.Error as e:
+                print('Cannot prune expired Perspective scores because ', e)
+
+    def get(self, text, attributes):
+        key = cache_key(text, attributes)
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute('SELECT stored, scores FROM scores WHERE key = ?', (key,)).fetchone()
+            if row and now - row[0] < self.ttl:
+                scores = json.loads(row[1])
+                self._remember(key, row[0], scores)
+                self.stats['hits'] += 1
+                self.stats['disk_hits'] += 1
+                return scores
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, text, attributes, scores):
+        key = cache_key(text, attributes)
+        now = time.time()
+        self._remember(key, now, scores)
+        if self._db is not None:
+            self._pending[key] = (now, json.dumps(scores))
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        # Scores that arrive while a batch is on disk go out with the next one
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                print('Cannot save Perspective scores because ', e)
+
+    async def flush(self):
+        rows, self._pending = self._pending, {}
+        if not rows:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, rows)
+
+    def _get_writer(self):
+        # Only ever used on the writer thread
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def _write(self, rows):
+        with self._get_writer() as writer:
+            writer.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)',
+                               [(key, stored, scores) for key, (stored, scores) in rows.items()])
+
+    def _prune(self):
+        with self._get_writer() as writer:
+            writer.execute('DELETE FROM scores WHERE stored < ?', (time.time() - self.ttl,))
+
+    def _remember(self, key, stored, scores):
+        self._entries[key] = (stored, scores)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    async def close(self):
+        if self._db is None:
+            return
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self._db.close()
+        self._db = None
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StateStore:
+    '''
+    SQLite-backed store for warning counts and in-progress reports.
+
+    Nothing is loaded up front: a user's row is read the first time it's needed. Writes are queued in
+    memory and flushed in batches by a background task on a dedicated writer thread, so moderation never
+    waits on the disk. The database runs in WAL mode, so several bot processes can share one file. Warning
+    increments are written as deltas so increments from different processes add up instead of overwriting
+    each other, and a cached count is re-read from disk after `refresh_interval` seconds.
+    '''
+
+    def __init__(self, path, flush_interval=0.5, refresh_interval=30):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.stats = {'reads': 0, 'flushes': 0, 'rows_written': 0}
+
+        self._reader = self._connect()
+        self._reader.executescript('''
+            CREATE TABLE IF NOT EXISTS warnings (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS reports (user_id INTEGER PRIMARY KEY, record TEXT NOT NULL);
+        ''')
+        self._writer = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-store')
+
+        self._counts = {} # Map from user ID to [count read from disk, increments since, time read]
+        self._pending_warnings = {} # Map from user ID to increments not yet written
+        self._unflushed = {} # Map from user ID to increments queued or being written
+        self._pending_reports = {} # Map from user ID to a report record, or None to delete it
+        self._flush_task = None
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only syncs at checkpoints; a power cut can lose the last few batches but never corrupts
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def warning_count(self, user_id):
+        entry = self._counts.get(user_id)
+        now = time.monotonic()
+        # Our own increments have to reach disk before a re-read can include them
+        stale = entry is None or (now - entry[2] > self.refresh_interval and not self._unflushed.get(user_id))
+        if stale:
+            self.stats['reads'] += 1
+            row = self._reader.execute('SELECT count FROM warnings WHERE user_id = ?', (user_id,)).fetchone()
+            entry = self._counts[user_id] = [row[0] if row else 0, 0, now]
+        return entry[0] + entry[1]
+
+    def increment_warning(self, user_id):
+        self.warning_count(user_id)
+        self._counts[user_id][1] += 1
+        self._pending_warnings[user_id] = self._pending_warnings.get(user_id, 0) + 1
+        self._unflushed[user_id] = self._unflushed.get(user_id, 0) + 1
+        self._schedule_flush()
+        return self.warning_count(user_id)
+
+    def load_report(self, user_id):
+        if user_id in self._pending_reports:
+            return self._pending_reports[user_id]
+        self.stats['reads'] += 1
+        row = self._reader.execute('SELECT record FROM reports WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_report(self, user_id, record):
+        self._pending_reports[user_id] = record
+        self._schedule_flush()
+
+    def delete_report(self, user_id):
+        self._pending_reports[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        # Writes that arrive while a batch is on disk go out with the next one
+        while self._pending_warnings or self._pending_reports:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                print('Cannot save moderation state because ', e)
+
+    async def flush(self):
+        warnings, self._pending_warnings = self._pending_warnings, {}
+        reports, self._pending_reports = self._pending_reports, {}
+        if not warnings and not reports:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, warnings, reports)
+        except Exception:
+            # Put the batch back so it goes out with the next flush; newer report records win
+            for user_id, delta in warnings.items():
+                self._pending_warnings[user_id] = self._pending_warnings.get(user_id, 0) + delta
+            for user_id, record in reports.items():
+                self._pending_reports.setdefault(user_id, record)
+            raise
+        for user_id, delta in warnings.items():
+            self._unflushed[user_id] -= delta
+            if not self._unflushed[user_id]:
+                del self._unflushed[user_id]
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(warnings) + len(reports)
+
+    def _write(self, warnings, reports):
+        if self._writer is None:
+            self._writer = self._connect()
+        with self._writer:
+            self._writer.executemany(
+                'INSERT INTO warnings VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count',
+                warnings.items())
+            self._writer.executemany('DELETE FROM reports WHERE user_id = ?',
+                                     [(user_id,) for user_id, record in reports.items() if record is None])
+            self._writer.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?)',
+                                     [(user_id, json.dumps(record)) for user_id, record in reports.items()
+                                      if record is not None])
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self._reader.close()
+        if self._writer is not None:
+            self._writer.close()